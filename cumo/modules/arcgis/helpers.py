@@ -0,0 +1,255 @@
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional
+import numpy as np
+from dateutil import parser
+
+# ArcGIS metadata (token validity, layers and fields) of the process by cache key
+METADATA = {}
+METADATA_LOCK = threading.Lock()
+METADATA_CACHE_DIR = os.path.join(tempfile.gettempdir(), "cumo-arcgis")
+
+
+def dump_compact(obj) -> str:
+    """
+    Serializes object to JSON without whitespace, values that are not JSON types are converted to strings
+    """
+    return json.dumps(obj, separators=(",", ":"), default=str)
+
+
+def pack_features(features:Iterable[dict], max_features:int, max_bytes:int) -> Iterator[tuple[str, list[dict]]]:
+    """
+    Packs features to JSON arrays limited by feature count and encoded size, every feature is serialized once.
+    Yields JSON array and its features. Feature larger than max_bytes is sent alone
+    """
+    parts, batch, size = [], [], 2 # brackets of the array
+    for feature in features:
+        part = dump_compact(feature)
+        part_size = len(part.encode("utf-8")) + 1 # comma
+        if batch and (len(batch) >= max_features or size + part_size > max_bytes):
+            yield "[" + ",".join(parts) + "]", batch
+            parts, batch, size = [], [], 2
+        parts.append(part)
+        batch.append(feature)
+        size += part_size
+    if batch:
+        yield "[" + ",".join(parts) + "]", batch
+
+
+def split_results(batch:List[dict], res:dict, key:str) -> tuple[int, List[tuple[dict, dict]]]:
+    """
+    Matches per feature results (addResults or updateResults) with sent features.
+    Returns amount of succeeded features and failed features with their errors, whole batch fails if the request failed
+    """
+    results = res.get(key)
+    if "error" in res or not isinstance(results, list) or len(results) != len(batch):
+        error = res.get("error") or {"description": f"{key} missing or not matching {len(batch)} features"}
+        return 0, [(feature, error) for feature in batch]
+    failed = [(feature, result.get("error") or {}) for feature, result in zip(batch, results) if not result.get("success")]
+    return len(batch) - len(failed), failed
+
+
+def to_geojson(features:List[dict]) -> bytes:
+    """
+    Converts ArcGIS point features to compact GeoJSON feature collection in WGS84
+    """
+    parts = []
+    for feature in features:
+        geometry = feature.get("geometry") or {}
+        point = None
+        if geometry.get("x") is not None and geometry.get("y") is not None:
+            point = {"type": "Point", "coordinates": [geometry["x"], geometry["y"]]}
+        parts.append(dump_compact({"type": "Feature", "geometry": point, "properties": feature["attributes"]}))
+    return ('{"type":"FeatureCollection","features":[' + ",".join(parts) + "]}").encode("utf-8")
+
+
+def field_mappings(features:List[dict], layer_cols:List[dict]) -> List[dict]:
+    """
+    Maps attributes of features to existing layer fields with the same name
+    """
+    names = {col["name"] for col in layer_cols if col["type"] not in ("esriFieldTypeOID", "esriFieldTypeGlobalID")}
+    cols = dict.fromkeys(col for feature in features for col in feature["attributes"])
+    return [{"name": col, "sourceName": col} for col in cols if col in names]
+
+
+STRING_TYPES = {"esriFieldTypeString", "esriFieldTypeGUID", "esriFieldTypeGlobalID"}
+DATE_TYPES = {"esriFieldTypeDate", "esriFieldTypeDateOnly", "esriFieldTypeTimestampOffset"}
+INTEGER_TYPES = {"esriFieldTypeInteger", "esriFieldTypeSmallInteger", "esriFieldTypeBigInteger", "esriFieldTypeOID"}
+NUMBER_TYPES = INTEGER_TYPES | {"esriFieldTypeSingle", "esriFieldTypeDouble"}
+COORD_DIGITS = 7 # ~1 cm, ArcGIS returns projected coordinates with rounding noise
+
+
+def to_epoch_ms(value) -> Optional[int]:
+    """
+    Converts date string, datetime or epoch milliseconds to epoch milliseconds, naive dates are UTC
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = parser.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def normalize_value(value, field_type:Optional[str] = None):
+    """
+    Normalizes attribute value for comparison with the value stored in ArcGIS, values are coerced to the field type
+    """
+    if field_type in NUMBER_TYPES and isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return value
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if field_type in DATE_TYPES:
+        return to_epoch_ms(value)
+    if field_type in INTEGER_TYPES and isinstance(value, (int, float)):
+        return int(round(value))
+    if field_type == "esriFieldTypeSingle" and isinstance(value, (int, float)):
+        # stored as float32, shortest float32 representation drops the noise of float64 values
+        value = float(str(np.float32(value)))
+    if isinstance(value, float):
+        value = int(value) if value.is_integer() else round(value, 9)
+    if field_type in STRING_TYPES:
+        return str(value)
+    return value
+
+
+def feature_key(feature:dict, keys:List[str], field_types:dict) -> tuple:
+    attributes = feature["attributes"]
+    return tuple(normalize_value(attributes.get(key), field_types.get(key)) for key in keys)
+
+
+def feature_hash(feature:dict, cols:Iterable[str], field_types:dict) -> str:
+    """
+    Hashes attributes in cols and point geometry of the feature
+    """
+    attributes = feature["attributes"]
+    geometry = feature.get("geometry") or {}
+    values = [normalize_value(attributes.get(col), field_types.get(col)) for col in cols]
+    point = [None if geometry.get(axis) is None else round(geometry[axis], COORD_DIGITS) for axis in ("x", "y")]
+    return hashlib.md5(dump_compact([values, point]).encode("utf-8")).hexdigest()
+
+
+def sql_literal(value, field_type:Optional[str] = None) -> str:
+    """
+    Formats value for ArcGIS where clause
+    """
+    if field_type in DATE_TYPES:
+        date = datetime.fromtimestamp(to_epoch_ms(value) / 1000, timezone.utc)
+        return f"TIMESTAMP '{date:%Y-%m-%d %H:%M:%S}'"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def diff_features(local:List[dict], remote:List[dict], keys:List[str], field_types:dict, oid_field:str, delete_missing:bool = False) -> dict:
+    """
+    Compares local features with features stored in ArcGIS by key columns.
+    Returns adds, updates (with object id of the stored feature), deletes (object ids), unchanged count and local duplicates.
+    Stored features with repeating key are deleted, only the first is kept
+    """
+    cols = sorted({col for feature in local for col in feature["attributes"]})
+
+    by_key = {}
+    duplicates = 0
+    for feature in local:
+        key = feature_key(feature, keys, field_types)
+        duplicates += key in by_key
+        by_key[key] = feature # last one wins
+
+    stored, deletes = {}, []
+    for feature in remote:
+        key = feature_key(feature, keys, field_types)
+        oid = feature["attributes"][oid_field]
+        if key in stored or (delete_missing and key not in by_key):
+            deletes.append(oid)
+        else:
+            stored[key] = feature
+
+    adds, updates, unchanged = [], [], 0
+    for key, feature in by_key.items():
+        if key not in stored:
+            adds.append(feature)
+        elif feature_hash(feature, cols, field_types) == feature_hash(stored[key], cols, field_types):
+            unchanged += 1
+        else:
+            update = dict(feature, attributes=dict(feature["attributes"]))
+            update["attributes"][oid_field] = stored[key]["attributes"][oid_field]
+            updates.append(update)
+
+    return {"adds": adds, "updates": updates, "deletes": deletes, "unchanged": unchanged, "duplicates": duplicates}
+
+
+def cache_path(cache_dir:str, key:str) -> str:
+    return os.path.join(cache_dir, hashlib.md5(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def get_cached(key:str, ttl:int, cache_dir:str):
+    """
+    Returns value stored less than ttl seconds ago from process memory or local disk, otherwise None
+    """
+    if ttl <= 0:
+        return None
+    with METADATA_LOCK:
+        entry = METADATA.get(key)
+    if entry is None:
+        try:
+            with open(cache_path(cache_dir, key)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry.get("key") != key:
+            return None
+        with METADATA_LOCK:
+            METADATA[key] = entry
+    if time.time() - entry["stored"] > ttl:
+        return None
+    return entry["value"]
+
+
+def set_cached(key:str, value, cache_dir:str) -> None:
+    """
+    Stores value in process memory and local disk, file is replaced atomically
+    """
+    entry = {"key": key, "stored": time.time(), "value": value}
+    with METADATA_LOCK:
+        METADATA[key] = entry
+    path = cache_path(cache_dir, key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(entry, f)
+        os.replace(f.name, path)
+    except OSError:
+        pass # disk copy is optional, memory copy is used in this process
+
+
+def invalidate_cached(prefix:str, cache_dir:str) -> None:
+    """
+    Removes entries with keys starting with prefix from process memory and local disk
+    """
+    with METADATA_LOCK:
+        for key in [key for key in METADATA if key.startswith(prefix)]:
+            del METADATA[key]
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            with open(path) as f:
+                key = json.load(f).get("key", "")
+            if key.startswith(prefix):
+                os.remove(path)
+        except (OSError, ValueError):
+            continue
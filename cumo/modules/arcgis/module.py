@@ -1,14 +1,24 @@
 import asyncio
+import hashlib
 import json
 import os
+import string
+from collections import Counter
+from datetime import datetime, timezone
 from typing import List, Optional
+from urllib.parse import quote
 import aiohttp
 from dagster import AssetsDefinition, ConfigurableResource, OpExecutionContext, asset, get_dagster_logger
 import dagster
+import pandas as pd
 import requests
+from minio.error import S3Error
+from pydantic import BaseModel
 
 from dagster_factory_pipelines import ModuleBase
 from ...utils.utils import timed_asset, asset_len
+from ...resources.resources import MinioBucket
+from .helpers import DATE_TYPES, METADATA_CACHE_DIR, diff_features, dump_compact, field_mappings, get_cached, invalidate_cached, normalize_value, pack_features, set_cached, split_results, sql_literal, to_geojson
 from dateutil import parser
 
 from dagster_factory_pipelines.factory.base import ModuleBase
@@ -28,16 +38,24 @@ class ArcGIS(ConfigurableResource):
     feature_service_address:str # services6.arcgis.com/P9oWcU3j68LVOKFp
     hostname: str = "tartu.maps.arcgis.com"
     skip_validation:bool = False
+    scheme: str = "https" # http allows a local stub feature service
+    cache_ttl: int = 3600 # seconds token validity, layers and fields are cached, 0 disables cache
+    cache_dir: str = METADATA_CACHE_DIR
 
     def model_post_init(self, ctx):
         """
-        Check that credentials are valid
+        Check that credentials are valid, valid token is cached for cache_ttl
         """
         
         if self.skip_validation:
             return
 
-        url = f"https://{self.hostname}/sharing/rest/community/self"
+        token_hash = hashlib.sha256((os.getenv(self.token) or "").encode("utf-8")).hexdigest()
+        key = f"token/{self.hostname}/{token_hash}"
+        if get_cached(key, self.cache_ttl, self.cache_dir):
+            return
+
+        url = f"{self.scheme}://{self.hostname}/sharing/rest/community/self"
         params = {
             "f": "pjson",
             "token": os.getenv(self.token)
@@ -50,26 +68,144 @@ class ArcGIS(ConfigurableResource):
         if "error" in res.text:
             raise dagster.DagsterError("Can not validate ArcGIS token. Provide valid ArcGIS token")
 
-    async def add_feature_async(self, session:aiohttp.ClientSession, layer_name:str, sublayer_id:int, obj:dict):
+        set_cached(key, True, self.cache_dir)
+
+    async def add_features_async(self, session:aiohttp.ClientSession, layer_name:str, sublayer_id:int, features:str) -> dict:
         """
-        Adds features to ArcGIS server in a asynchronous way
+        Adds batch of features (JSON array) to ArcGIS server, features are sent as form encoded body
         """
-        params = {
+        data = {
             "f": "json",
-            "features": json.dumps(obj, indent=4, sort_keys=True, default=str),
+            "features": features,
             "token": os.getenv(self.token)
         }
-        url = f"https://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}/addFeatures"
-        async with session.post(url, params=params) as res:
-            data = await res.read()
-            response_json = json.loads(data)
-            return response_json
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}/addFeatures"
+        async with session.post(url, data=data) as res:
+            return json.loads(await res.read())
+
+    async def query_features_async(self, session:aiohttp.ClientSession, layer_name:str, sublayer_id:int, where:str, oid_field:str, page_size:int = 2000) -> List[dict]:
+        """
+        Queries all features matching where clause page by page, geometry is returned in WGS84
+        """
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}/query"
+        features = []
+        while True:
+            data = {
+                "f": "json",
+                "where": where,
+                "outFields": "*",
+                "returnGeometry": "true",
+                "outSR": 4326,
+                "orderByFields": oid_field,
+                "resultOffset": len(features),
+                "resultRecordCount": page_size,
+                "token": os.getenv(self.token)
+            }
+            async with session.post(url, data=data) as res:
+                page = json.loads(await res.read())
+            if "error" in page:
+                raise dagster.DagsterError(f"ArcGIS query failed: {page['error']}")
+            features.extend(page.get("features", []))
+            if not page.get("exceededTransferLimit") or not page.get("features"):
+                return features
+
+    async def apply_edits_async(self, session:aiohttp.ClientSession, layer_name:str, sublayer_id:int, adds:str = "[]", updates:str = "[]", deletes:str = "") -> dict:
+        """
+        Applies adds and updates (JSON arrays) and deletes (comma separated object ids) in one request
+        """
+        data = {
+            "f": "json",
+            "adds": adds,
+            "updates": updates,
+            "deletes": deletes,
+            "rollbackOnFailure": "false",
+            "token": os.getenv(self.token)
+        }
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}/applyEdits"
+        async with session.post(url, data=data) as res:
+            return json.loads(await res.read())
+
+    async def upload_async(self, session:aiohttp.ClientSession, layer_name:str, file_name:str, content:bytes) -> str:
+        """
+        Uploads file to feature service, returns item id of the upload
+        """
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/uploads/upload"
+        form = aiohttp.FormData()
+        form.add_field("f", "json")
+        form.add_field("token", os.getenv(self.token) or "")
+        form.add_field("file", content, filename=file_name, content_type="application/geo+json")
+        async with session.post(url, data=form) as res:
+            data = json.loads(await res.read())
+        if not data.get("success"):
+            raise dagster.DagsterError(f"ArcGIS upload failed: {data.get('error', data)}")
+        return data["item"]["itemID"]
+
+    async def delete_upload_async(self, session:aiohttp.ClientSession, layer_name:str, item_id:str) -> None:
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/uploads/{item_id}/delete"
+        async with session.post(url, data={"f": "json", "token": os.getenv(self.token) or ""}) as res:
+            await res.read()
+
+    async def append_async(self, session:aiohttp.ClientSession, layer_name:str, sublayer_id:int, item_id:str, mappings:List[dict], poll_interval:float = 2, timeout:float = 3600) -> dict:
+        """
+        Appends uploaded GeoJSON to sublayer and waits until the asynchronous job is finished, returns final job status
+        """
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}/append"
+        data = {
+            "f": "json",
+            "appendUploadId": item_id,
+            "appendUploadFormat": "geojson",
+            "fieldMappings": json.dumps(mappings),
+            "upsert": "false",
+            "rollbackOnFailure": "true",
+            "async": "true",
+            "token": os.getenv(self.token) or ""
+        }
+        async with session.post(url, data=data) as res:
+            job = json.loads(await res.read())
+        if "statusUrl" not in job:
+            raise dagster.DagsterError(f"ArcGIS append failed: {job.get('error', job)}")
+
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            async with session.get(job["statusUrl"], params={"f": "json", "token": os.getenv(self.token) or ""}) as res:
+                status = json.loads(await res.read())
+            if status.get("status") in ("Completed", "CompletedWithErrors", "Failed"):
+                return status
+            if asyncio.get_running_loop().time() > deadline:
+                raise dagster.DagsterError(f"ArcGIS append job did not finish in {timeout} seconds: {status}")
+            await asyncio.sleep(poll_interval)
 
-    def get_layer_cols(self, layer_name:str, sublayer_id:int) -> List[str]:
+    def get_layer_cols(self, layer_name:str, sublayer_id:int, refresh:bool = False) -> List[dict]:
         """
-        Retrieves existing column names for layer_name with sublayer_id
+        Retrieves existing columns for layer_name with sublayer_id, cached for cache_ttl unless refresh
         """
-        url = f"https://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}"
+        key = f"{self.feature_service_address}/{layer_name}/{sublayer_id}/fields"
+        fields = None if refresh else get_cached(key, self.cache_ttl, self.cache_dir)
+        if fields is None:
+            fields = self.__get_layer_cols(layer_name, sublayer_id)
+            set_cached(key, fields, self.cache_dir)
+        return fields
+
+    def get_layers(self, layer_name:str, refresh:bool = False) -> List[dict]:
+        """
+        Retrieves existing sublayers for the layer_name, cached for cache_ttl unless refresh
+        """
+        key = f"{self.feature_service_address}/{layer_name}/layers"
+        layers = None if refresh else get_cached(key, self.cache_ttl, self.cache_dir)
+        if layers is None:
+            layers = self.__get_layers(layer_name)
+            set_cached(key, layers, self.cache_dir)
+        return layers
+
+    def invalidate_cache(self, layer_name:Optional[str] = None) -> None:
+        """
+        Removes cached layers and fields of layer_name or of the whole feature service
+        """
+        prefix = f"{self.feature_service_address}/{layer_name}/" if layer_name else f"{self.feature_service_address}/"
+        invalidate_cached(prefix, self.cache_dir)
+
+    def __get_layer_cols(self, layer_name:str, sublayer_id:int) -> List[dict]:
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer/{sublayer_id}"
         params = {
             "f": "json",
             "token": os.getenv(self.token)
@@ -77,11 +213,8 @@ class ArcGIS(ConfigurableResource):
         res = requests.get(url, params=params).json()
         return res["fields"]
 
-    def get_layers(self, layer_name:str) -> List[str]:
-        """
-        Retrieves existing sublayers for the layer_name
-        """
-        url = f"https://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer"
+    def __get_layers(self, layer_name:str) -> List[dict]:
+        url = f"{self.scheme}://{self.feature_service_address}/arcgis/rest/services/{layer_name}/FeatureServer"
         params = {
             "f": "json",
             "token":os.getenv(self.token)
@@ -112,23 +245,47 @@ class transform_to_argcis_format(ModuleBase):
         @asset_len
         @timed_asset
         def transform_to_arcgis_format(context:OpExecutionContext, data:List[dict]) -> List:
-            res = []
-            for measurement in data:
-                res.append(
-                    {
-                        "attributes":measurement,
-                        "geometry": {
-                            "x": measurement.pop(self.lng, None),
-                            "y": measurement.pop(self.lat, None),
-                            "spatialReference": { "wkid": 4326},
-                        }
-                    }
-
-                    )
+            res = self.to_features(data)
             context.log.info(res)
             return res
         return transform_to_arcgis_format
+
+    def to_features(self, data:List[dict]) -> List[dict]:
+        res = []
+        for measurement in data:
+            res.append(
+                {
+                    "attributes":measurement,
+                    "geometry": {
+                        "x": measurement.pop(self.lng, None),
+                        "y": measurement.pop(self.lat, None),
+                        "spatialReference": { "wkid": 4326},
+                    }
+                }
+
+                )
+        return res
+
+    def finalize_df(self, context:OpExecutionContext, df:pd.DataFrame) -> List[dict]:
+        """
+        Transforms dataframe to ArcGIS features. Used by ld.chain as the last step.
+        Missing values are sent as nulls, because NaN is not valid JSON
+        """
+        df = df.astype(object).where(df.notna(), None)
+        return self.to_features(df.to_dict(orient="records"))
     
+class Upsert(BaseModel):
+    keys: List[str] # columns identifying a feature, such as source_id and date_
+    range_col: Optional[str] = None # stored features are queried between min and max of this column in data
+    where: Optional[str] = None # additional filter of stored features
+    delete_missing: bool = False # deletes stored features in range which are not in data
+    page_size: int = 2000 # features in one query response
+
+class DeadLetter(BaseModel):
+    bucket: str
+    prefix: str = "arcgis/dead_letter" # objects are stored under prefix/layer_name/sublayer_name/
+    drain: bool = True # stored features are sent again before data of the next run
+
 @register_module('send_to_arcgis')
 class send_to_arcgis(ModuleBase):
 
@@ -138,70 +295,330 @@ class send_to_arcgis(ModuleBase):
     create_sublayer: Optional[bool] = False
     col_types: Optional[dict] = None
     req_cols: Optional[List] = None
+    batch_size: int = 1000 # features in one addFeatures request
+    max_batch_bytes: int = 2 * 1024 * 1024 # encoded features in one request
+    concurrency: int = 4 # requests in flight
+    upsert: Optional[Upsert] = None # sends only changed features instead of adding all
+    append_threshold: Optional[int] = None # rows from which features are uploaded and appended in one job, None disables
+    poll_interval: float = 2 # seconds between append job status requests
+    append_timeout: float = 3600 # seconds append job may run
+    retries: int = 3 # times failed features are sent again
+    backoff: float = 1 # seconds before the first retry, doubled for every next retry
+    dead_letter: Optional[DeadLetter] = None # stores features failed after retries in minio
     
     # class var
     sublayer_id: str = ""
 
     def create_asset(self) -> AssetsDefinition:
-            @asset(
+            if min(self.batch_size, self.max_batch_bytes, self.concurrency) < 1:
+                raise ValueError("batch_size, max_batch_bytes and concurrency must be positive")
+            if self.upsert:
+                self.__validate_upsert()
+            if self.retries < 0 or self.backoff < 0:
+                raise ValueError("retries and backoff can not be negative")
+
+            def load_cumu_data(context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict]) -> None:
+                self.__load(context, arcGIS, data)
+
+            def load_cumu_data_dead_letter(context:OpExecutionContext, arcGIS:ArcGIS, minio:MinioBucket, data:List[dict]) -> None:
+                self.__load(context, arcGIS, data, minio)
+
+            # minio resource is requested only when failed features are stored
+            return asset(
                     **self.asset_args,
                     description="Upload data to sql db",
                     compute_kind="SQL",
-                )
-            @timed_asset
-            def load_cumu_data(context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict]) -> None:
-                self.__get_sublayer_id(arcGIS)
-                self.__validate_table(arcGIS, data[0])
+                )(timed_asset(load_cumu_data_dead_letter if self.dead_letter else load_cumu_data))
+
+    def __load(self, context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict], minio:Optional[MinioBucket] = None) -> None:
+        self.__get_sublayer_id(arcGIS)
+        layer_cols = self.__validate_table(arcGIS, data[0])
+
+        context.log.info(self.sublayer_id)
+        context.log.info(self.layer_name)
+        context.log.info(self.sublayer_name)
+
+        failed, dead_lettered = [], 0
+        if self.dead_letter and self.dead_letter.drain:
+            drained, entries = self.__read_dead_letter(context, minio)
+            if entries:
+                # drained objects are replaced before the load, so a failing load does not send them again
+                drain_failed = asyncio.run(self.__drain(context, arcGIS, entries))
+                dead_lettered += self.__write_dead_letter(context, minio, drain_failed, drained)
 
-                context.log.info(self.sublayer_id)
-                context.log.info(self.layer_name)
-                context.log.info(self.sublayer_name)
+        if self.upsert:
+            failed += asyncio.run(self.__upsert(context, arcGIS, data, layer_cols))
+        elif self.append_threshold is not None and len(data) >= self.append_threshold:
+            failed += asyncio.run(self.__append(context, arcGIS, data, layer_cols))
+        else:
+            failed += asyncio.run(self.__main(context, arcGIS, data))
 
-                asyncio.run(self.__main(context, arcGIS, data))
-            return load_cumu_data
+        errors = Counter(str(entry["error"].get("code", "request")) for entry in failed)
+        context.add_output_metadata({"failed": len(failed), "errors": dict(errors)})
+        if failed and not self.dead_letter:
+            context.log.error(f"{len(failed)} features failed after {self.retries} retries: {dict(errors)}")
+        if self.dead_letter:
+            dead_lettered += self.__write_dead_letter(context, minio, failed)
+            context.add_output_metadata({"dead_lettered": dead_lettered})
     
 
-    async def __main(self, context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict]):
+    async def __main(self, context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict]) -> List[dict]:
+        """
+        Sends features in batches, amount of requests in flight is limited by semaphore.
+        Returns features failed after retries
+        """
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            stats, failed = await self.__send_features(context, arcGIS, session, data, "add")
+
+        context.log.info(f"{stats['succeeded']} of {len(data)} features added with {stats['requests']} requests")
+        context.add_output_metadata({"requests": stats["requests"], "features": len(data), "added": stats["succeeded"], "retried": stats["retried"]})
+        return failed
+
+    async def __send_features(self, context:OpExecutionContext, arcGIS:ArcGIS, session:aiohttp.ClientSession, features:List[dict], edit:str) -> tuple[Counter, List[dict]]:
+        """
+        Sends adds or updates in batches, failed features are sent again with exponential backoff.
+        Returns succeeded, retried and requests counts and features failed after retries with their errors
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stats = Counter(succeeded=0, retried=0, requests=0)
+
+        async def send(features_json:str, batch:List[dict]) -> tuple[int, list]:
+            stats["requests"] += 1
+            try:
+                async with semaphore:
+                    if edit == "add":
+                        res = await arcGIS.add_features_async(session, self.layer_name, self.sublayer_id, features_json)
+                    else:
+                        res = await arcGIS.apply_edits_async(session, self.layer_name, self.sublayer_id, updates=features_json)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                res = {"error": {"description": repr(e)}}
+            return split_results(batch, res, f"{edit}Results")
+
+        pending, failed = features, []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                context.log.warning(f"{len(pending)} {edit}s failed, retry {attempt} of {self.retries} in {delay} seconds")
+                await asyncio.sleep(delay)
+                stats["retried"] += len(pending)
+            results = await asyncio.gather(*[send(features_json, batch) for features_json, batch in pack_features(pending, self.batch_size, self.max_batch_bytes)])
+            stats["succeeded"] += sum(succeeded for succeeded, _ in results)
+            failed = [failure for _, failures in results for failure in failures]
+            pending = [feature for feature, _ in failed]
+            if not failed:
+                break
+
+        return stats, [{"edit": edit, "feature": feature, "error": error} for feature, error in failed]
+
+    async def __drain(self, context:OpExecutionContext, arcGIS:ArcGIS, entries:List[dict]) -> List[dict]:
+        """
+        Sends features from dead letter objects again, returns features that still fail
+        """
+        failed, stats = [], Counter()
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency)) as session:
+            for edit in ("add", "update"):
+                features = [entry["feature"] for entry in entries if entry["edit"] == edit]
+                if features:
+                    edit_stats, edit_failed = await self.__send_features(context, arcGIS, session, features, edit)
+                    stats.update(edit_stats)
+                    failed += edit_failed
+
+        context.log.info(f"{stats['succeeded']} of {len(entries)} dead letter features sent")
+        context.add_output_metadata({"drained": len(entries), "drained_sent": stats["succeeded"], "drained_retried": stats["retried"]})
+        return failed
+
+    def __dead_letter_prefix(self, context:OpExecutionContext) -> str:
+        """
+        Dead letter objects are kept per partition, so parallel partition runs do not drain each other's objects
+        """
+        partition = context.partition_key if context.has_partition_key else "all"
+        return f"{self.dead_letter.prefix}/{self.layer_name}/{self.sublayer_name}/{quote(str(partition), safe='')}/"
+
+    def __read_dead_letter(self, context:OpExecutionContext, minio:MinioBucket) -> tuple[List[str], List[dict]]:
         """
-        Creates async tasks and execute them
+        Reads dead letter objects of the current partition, returns object names and failed features
         """
+        try:
+            names = [obj.object_name for obj in minio.list_objs(self.dead_letter.bucket, self.__dead_letter_prefix(context))]
+        except S3Error as e:
+            if e.code == "NoSuchBucket":
+                return [], []
+            raise
+        objs = minio.get_objs(self.dead_letter.bucket, names, missing_ok=True)
+        entries = [entry for obj in objs.values() for entry in json.load(obj)["features"]]
+        if entries:
+            context.log.info(f"Draining {len(entries)} features from {len(objs)} dead letter objects")
+        return list(objs), entries
+
+    def __write_dead_letter(self, context:OpExecutionContext, minio:MinioBucket, failed:List[dict], drained:Optional[List[str]] = None) -> int:
+        """
+        Stores failed features in a new dead letter object and removes drained objects.
+        New object is written first, so features are not lost if removing fails. Returns amount of stored features
+        """
+        if failed:
+            file_name = f"{self.__dead_letter_prefix(context)}{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}.json"
+            partition = context.partition_key if context.has_partition_key else None
+            content = {"layer_name": self.layer_name, "sublayer_name": self.sublayer_name, "partition": partition, "features": failed}
+            minio.upload_obj(self.dead_letter.bucket, file_name, dump_compact(content).encode("utf-8"))
+            context.log.warning(f"{len(failed)} failed features stored in {self.dead_letter.bucket}/{file_name}")
+        for name in drained or []:
+            minio.remove_obj(self.dead_letter.bucket, name)
+        return len(failed)
+
+    async def __append(self, context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict], layer_cols:List[dict]) -> List[dict]:
+        """
+        Uploads features as GeoJSON and appends them to sublayer in one server side job.
+        Failed job is rolled back, then features are sent in batches and returns features failed after retries
+        """
+        content = to_geojson(data)
+        mappings = field_mappings(data, layer_cols)
+        context.log.info(f"Appending {len(data)} features from {len(content)} bytes GeoJSON")
 
         async with aiohttp.ClientSession() as session:
+            item_id = await arcGIS.upload_async(session, self.layer_name, f"{self.sublayer_name}.geojson", content)
+            try:
+                status = await arcGIS.append_async(session, self.layer_name, self.sublayer_id, item_id, mappings, self.poll_interval, self.append_timeout)
+            finally:
+                await arcGIS.delete_upload_async(session, self.layer_name, item_id)
 
-            tasks = []
-            for feat in data:
-                tasks.append(asyncio.ensure_future(
-                    arcGIS.add_feature_async(
-                        session,
-                        self.layer_name,
-                        self.sublayer_id,feat
-                        )
-                    )
-                )
+        job_status = status.get("status")
+        context.add_output_metadata({"mode": "append", "append_status": job_status, "upload_bytes": len(content)})
+        if job_status == "Failed":
+            context.log.warning(f"Append job failed, features are sent in batches: {status.get('error') or status}")
+            context.add_output_metadata({"append_error": dagster.MetadataValue.json(status.get("error") or status)})
+            return await self.__main(context, arcGIS, data)
+        if job_status == "CompletedWithErrors":
+            # the job does not report which features failed, details are kept for the run
+            context.log.warning(f"Append job completed with errors: {status}")
+            context.add_output_metadata({"append_error": dagster.MetadataValue.json(status)})
+        else:
+            context.log.info(f"Append job completed: {status}")
+        context.add_output_metadata({"requests": 1, "features": len(data), "added": len(data)})
+        return []
+
+    async def __upsert(self, context:OpExecutionContext, arcGIS:ArcGIS, data:List[dict], layer_cols:List[dict]) -> List[dict]:
+        """
+        Queries stored features in the key range of data and applies only needed adds, updates and deletes.
+        Returns adds and updates failed after retries
+        """
+        self.create_pk(context)
+        field_types = {col["name"]: col["type"] for col in layer_cols}
+        oid_field = next(col["name"] for col in layer_cols if col["type"] == "esriFieldTypeOID")
+        where = self.__upsert_where(data, field_types)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def delete(session:aiohttp.ClientSession, deletes:List[int]) -> int:
+            async with semaphore:
+                res = await arcGIS.apply_edits_async(session, self.layer_name, self.sublayer_id, deletes=",".join(map(str, deletes)))
+            deleted, failed = split_results(deletes, res, "deleteResults")
+            if failed:
+                context.log.warning(f"{len(failed)} of {len(deletes)} deletes failed: {failed[0][1]}")
+            return deleted
 
-            arcgis_res = await asyncio.gather(*tasks)
-            for arcgis_res in arcgis_res:
-                context.log.info(arcgis_res)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            remote = await arcGIS.query_features_async(session, self.layer_name, self.sublayer_id, where, oid_field, self.upsert.page_size)
+            diff = diff_features(data, remote, self.upsert.keys, field_types, oid_field, self.upsert.delete_missing)
+            context.log.info(f"{len(remote)} stored features for {where}: {len(diff['adds'])} adds, {len(diff['updates'])} updates, {len(diff['deletes'])} deletes, {diff['unchanged']} unchanged")
+            if diff["duplicates"]:
+                context.log.warning(f"{diff['duplicates']} features with repeating keys {self.upsert.keys}, last ones are sent")
+
+            added, failed_adds = await self.__send_features(context, arcGIS, session, diff["adds"], "add")
+            updated, failed_updates = await self.__send_features(context, arcGIS, session, diff["updates"], "update")
+            deleted = await asyncio.gather(*[delete(session, diff["deletes"][i:i + self.batch_size]) for i in range(0, len(diff["deletes"]), self.batch_size)])
+
+        context.add_output_metadata({
+            "requests": added["requests"] + updated["requests"] + len(deleted),
+            "features": len(data),
+            "stored": len(remote),
+            "added": added["succeeded"],
+            "updated": updated["succeeded"],
+            "deleted": sum(deleted),
+            "unchanged": diff["unchanged"],
+            "retried": added["retried"] + updated["retried"],
+        })
+        return failed_adds + failed_updates
+
+    def __validate_upsert(self) -> None:
+        """
+        Checks that stored features are queried only for the partition, so other partitions are not compared or deleted
+        """
+        if not self.upsert.keys:
+            raise ValueError("upsert requires keys")
+        if not (self.upsert.range_col or self.upsert.where):
+            raise ValueError("upsert requires range_col or where, otherwise the whole layer is compared with data")
+        # names set by create_pk, only multi partitions have both date and static
+        main_partition = str(type(self.partition.main_partition)) if self.partition else ""
+        if "Multi" in main_partition:
+            names = {"date", "static"}
+        elif "Daily" in main_partition:
+            names = {"date"}
+        else:
+            names = {"static"} if self.partition else set()
+        fields = {field for _, field, _, _ in string.Formatter().parse(self.upsert.where or "") if field is not None}
+        if fields - names:
+            raise ValueError(f"upsert.where can use only partition keys {sorted(names)}, got {sorted(fields)}")
+        if self.upsert.delete_missing and self.partition and self.partition.elements_partition and "static" not in fields:
+            raise ValueError("upsert.delete_missing requires upsert.where scoped to the partition element with {static}")
+
+    def __upsert_where(self, data:List[dict], field_types:dict) -> str:
+        """
+        Builds where clause selecting stored features of the partition in the range of data.
+        upsert.where is formatted with partition keys, key columns are limited to their values in data
+        """
+        clauses = [f"({self.upsert.where.format(**self.pk)})"] if self.upsert.where else []
+        col = self.upsert.range_col
+        if col:
+            field_type = field_types.get(col)
+            values = [normalize_value(feat["attributes"].get(col), field_type) for feat in data]
+            values = [value for value in values if value is not None]
+            if not values:
+                # querying without range would compare data with the whole layer
+                raise dagster.DagsterError(f"Upsert range column {col} has no values in data")
+            if field_type in DATE_TYPES:
+                # values are epoch milliseconds, timestamps in where clause have second precision, end is the next second
+                start, end = min(values) // 1000 * 1000, max(values) // 1000 * 1000 + 1000
+                clauses.append(f"{col} >= {sql_literal(start, field_type)} AND {col} < {sql_literal(end, field_type)}")
+            else:
+                clauses.append(f"{col} >= {sql_literal(min(values), field_type)} AND {col} <= {sql_literal(max(values), field_type)}")
+
+        for key in self.upsert.keys:
+            field_type = field_types.get(key)
+            if key == col or field_type in DATE_TYPES:
+                continue # dates are limited by range, timestamp literals have only second precision
+            values = {normalize_value(feat["attributes"].get(key), field_type) for feat in data}
+            literals = ", ".join(sorted(sql_literal(value, field_type) for value in values if value is not None))
+            clause = f"{key} IN ({literals})" if literals else ""
+            if None in values:
+                clause = f"({clause} OR {key} IS NULL)" if clause else f"{key} IS NULL"
+            clauses.append(clause)
+        return " AND ".join(clauses)
 
     def __get_sublayer_id(self, arcGIS:ArcGIS) -> None:
             """
-            Gets and sets current layer id
+            Gets and sets current layer id, cached layers are refreshed if sublayer is missing
             """
-            self.sublayer_id = [layer["id"] for layer in arcGIS.get_layers(self.layer_name) if self.sublayer_name == layer["name"]][0]
+            ids = [layer["id"] for layer in arcGIS.get_layers(self.layer_name) if self.sublayer_name == layer["name"]]
+            if not ids:
+                ids = [layer["id"] for layer in arcGIS.get_layers(self.layer_name, refresh=True) if self.sublayer_name == layer["name"]]
+            self.sublayer_id = ids[0]
 
 
-    def __validate_table(self, arcGIS:ArcGIS, data:dict) -> None:
+    def __validate_table(self, arcGIS:ArcGIS, data:dict) -> List[dict]:
         """
-        Checks if table columns present in ArcGIS
+        Checks if table columns present in ArcGIS, returns ArcGIS fields. Cached fields are refreshed if a column is missing
         """
+        data_cols = self.req_cols if self.req_cols else list(data["attributes"].keys())
         layer_cols = arcGIS.get_layer_cols(self.layer_name, self.sublayer_id)
+        if not set(data_cols) <= {col["name"] for col in layer_cols}:
+            layer_cols = arcGIS.get_layer_cols(self.layer_name, self.sublayer_id, refresh=True)
         arcgis_cols = [col["name"] for col in layer_cols]
-        data_cols = self.req_cols if self.req_cols else list(data["attributes"].keys())
         for col in data_cols:
             if col not in arcgis_cols:
                 raise Exception(f"Column {col} does not exists in ArcGIS table")
 
-        return
+        return layer_cols
 @register_module('correct_timestamps')
 class correct_timestamps(ModuleBase):
 
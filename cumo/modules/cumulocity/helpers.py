@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from ..general.helpers import read_csv_file
+
+# parsed inventories of the process by (bucket, object name)
+INVENTORIES = {}
+INVENTORIES_LOCK = threading.Lock()
+INVENTORY_CACHE_DIR = os.path.join(tempfile.gettempdir(), "cumo-inventory")
+ETAG_KEY = b"cumo.etag"
+
+
+def normalize_keys(keys:pd.Series) -> pd.Series:
+    """
+    Converts ids to strings, so 123, 123.0, "123" and " 123" are the same key.
+    Missing ids stay missing
+    """
+    normalized = keys.astype(str).str.strip()
+    numeric = pd.to_numeric(keys, errors="coerce")
+    integral = numeric.notna() & np.isfinite(numeric) & (numeric % 1 == 0)
+    normalized[integral] = numeric[integral].astype("int64").astype(str)
+    return normalized.where(keys.notna())
+
+
+class Inventory:
+    """
+    Parsed inventory with lookup tables indexed by normalized key
+    """
+    def __init__(self, df:pd.DataFrame, etag:str = None):
+        self.df = df
+        self.etag = etag
+        self.lookups = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key:str) -> tuple[pd.DataFrame, int]:
+        """
+        Returns inventory indexed by normalized key column and amount of repeated keys. First row is used for repeated keys
+        """
+        with self.lock:
+            if key not in self.lookups:
+                keys = normalize_keys(self.df[key])
+                inventory = self.df.assign(_key=keys).dropna(subset="_key")
+                duplicates = int(inventory["_key"].duplicated().sum())
+                self.lookups[key] = (inventory.drop_duplicates("_key").set_index("_key"), duplicates)
+            return self.lookups[key]
+
+
+def get_inventory(minio, bucket:str, file_name:str, cache_dir:str = INVENTORY_CACHE_DIR) -> tuple[Inventory, str]:
+    """
+    Returns parsed inventory from process memory or local disk if object etag is not changed,
+    otherwise downloads and parses CSV file. Unchanged inventory costs one stat request.
+    Second value is the inventory source: memory, disk or download
+    """
+    etag = minio.stat_obj(bucket, file_name).etag
+    with INVENTORIES_LOCK:
+        inventory = INVENTORIES.get((bucket, file_name))
+    if inventory and inventory.etag == etag:
+        return inventory, "memory"
+
+    path = os.path.join(cache_dir, bucket, file_name + ".parquet")
+    inventory, source = read_cached_inventory(path, etag), "disk"
+    if inventory is None:
+        inventory, source = Inventory(read_csv_file(minio.get_obj(bucket, file_name)), etag), "download"
+        write_cached_inventory(path, inventory)
+
+    with INVENTORIES_LOCK:
+        INVENTORIES[(bucket, file_name)] = inventory
+    return inventory, source
+
+
+def read_cached_inventory(path:str, etag:str):
+    try:
+        table = pq.read_table(path)
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+    if (table.schema.metadata or {}).get(ETAG_KEY) != etag.encode():
+        return None
+    return Inventory(table.to_pandas(), etag)
+
+
+def write_cached_inventory(path:str, inventory:Inventory) -> None:
+    """
+    Stores parsed inventory with etag as parquet file. Inventories that can not be stored are only kept in memory
+    """
+    try:
+        table = pa.Table.from_pandas(inventory.df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return
+    table = table.replace_schema_metadata({**table.schema.metadata, ETAG_KEY: inventory.etag.encode()})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as file:
+        pq.write_table(table, file)
+    # other processes may read the same file
+    os.replace(tmp_path, path)
+
+
+def left_join_values(df:pd.DataFrame, key:str, lookup:pd.DataFrame, values:dict) -> tuple[pd.DataFrame, dict]:
+    """
+    Joins lookup columns (values keys) to the dataframe as values columns by normalized key.
+    Not matched rows keep existing values or get NaN. Returns dataframe and join statistics
+    """
+    keys = normalize_keys(df[key]) if key in df else pd.Series(np.nan, index=df.index, dtype=object)
+    matched = keys.isin(lookup.index)
+    joined = lookup[list(values)].reindex(keys.to_numpy())
+    joined.index = df.index
+
+    df = df.copy()
+    for inventory_col, col in values.items():
+        df[col] = joined[inventory_col].where(matched, df[col]) if col in df else joined[inventory_col]
+
+    not_matched = keys[~matched]
+    return df, {
+        "matched_rows": int(matched.sum()),
+        "unmatched_rows": int((~matched).sum()),
+        "unmatched_keys": int(not_matched.nunique(dropna=False)),
+        "unmatched_keys_sample": ", ".join(map(str, not_matched.drop_duplicates().head(10))),
+    }
+
+
+def merge_changes(inventory:pd.DataFrame, changes:pd.DataFrame, key:str, deleted:pd.Series) -> tuple[pd.DataFrame, dict]:
+    """
+    Upserts changed objects into inventory by normalized key and removes deleted ones.
+    Changes should be ordered by update time, the latest change of the key wins
+    """
+    inventory_keys = normalize_keys(inventory[key]) if key in inventory else pd.Series(dtype=object)
+    change_keys = normalize_keys(changes[key])
+    latest = ~change_keys.duplicated(keep="last")
+    changes, change_keys, deleted = changes[latest], change_keys[latest], deleted[latest]
+
+    existing = change_keys.isin(inventory_keys)
+    merged = pd.concat([inventory[~inventory_keys.isin(change_keys).to_numpy()], changes[~deleted]], ignore_index=True)
+    return merged, {
+        "inserted": int((~existing & ~deleted).sum()),
+        "updated": int((existing & ~deleted).sum()),
+        "deleted": int((existing & deleted).sum()),
+        "rows": merged.shape[0],
+    }
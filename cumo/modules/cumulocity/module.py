@@ -1,8 +1,14 @@
-from typing import List, Optional
+import json
+from datetime import datetime, timezone
+from typing import Any, ClassVar, List, Optional
 from dagster import AssetsDefinition, OpExecutionContext, asset
 from pydantic import BaseModel
 from dagster_factory_pipelines import ModuleBase, registry
 from ...utils.utils import df_info, df_rows, timed_asset, get_range_based_on_type
+from minio.error import S3Error
+from .helpers import Inventory, get_inventory, left_join_values, merge_changes
+from ..myrequests.helpers import read_json_obj
+from ..general.helpers import read_csv_file
 import pandas as pd
 
 class Minio(BaseModel):
@@ -13,6 +19,11 @@ class TimeSeriesDuplicate(BaseModel):
     base_col:str
     value_col:str
 
+class Deletions(BaseModel):
+    column: str
+    values: List[Any] = [] # objects with these values are deleted
+    missing: bool = False # objects without value are deleted
+
 class ModuleParams(BaseModel):
     minio: Optional[Minio] = None
     sources: Optional[List[str]] = None
@@ -32,21 +43,27 @@ class remove_duplicates(ModuleBase):
                 **self.asset_args
         )
         def remove_duplicates(context:OpExecutionContext, data:list[dict]) -> list[dict]: 
-            df = pd.DataFrame(data).drop_duplicates()
-            init_size = df.shape[0]
-
-            if self.remove_timeseries_duplicates:
-                duplicated_value, value_base = self.remove_timeseries_duplicates.value_col, self.remove_timeseries_duplicates.base_col
-                df = df[df[duplicated_value] != df.groupby(value_base)[duplicated_value].shift()]
-
-            final_size = df.shape[0]
-            context.add_output_metadata({
-                "duplicates_removed": init_size-final_size,
-                "duplicate_ratio": (init_size-final_size)/init_size * 100
-                }
-                )
+            df, metadata = self.process_df(context, pd.DataFrame(data))
+            context.add_output_metadata(metadata)
             return df.to_dict(orient="records")
         return remove_duplicates
+
+    def process_df(self, context:OpExecutionContext, df:pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+        """
+        Removes duplicates from the dataframe, returns dataframe and metadata. Used by asset and ld.chain
+        """
+        df = df.drop_duplicates()
+        init_size = df.shape[0]
+
+        if self.remove_timeseries_duplicates:
+            duplicated_value, value_base = self.remove_timeseries_duplicates.value_col, self.remove_timeseries_duplicates.base_col
+            df = df[df[duplicated_value] != df.groupby(value_base)[duplicated_value].shift()]
+
+        final_size = df.shape[0]
+        return df, {
+            "duplicates_removed": init_size-final_size,
+            "duplicate_ratio": (init_size-final_size)/init_size * 100
+            }
     
 
     
@@ -54,43 +71,115 @@ class remove_duplicates(ModuleBase):
 class inject_inventory_s3(ModuleBase):
     """
     Injects required values from inventory to the list of dictionaries.
-    Uses id on common pattern to detect possible injection value.
+    Values are joined by key, ids are compared as strings, so 123, 123.0 and "123" match.
     Designed primarily for working with CSV files
     """
     minio: Minio
     key: str
     csv_key: str
     inject_values: dict
+    cache: bool = True # keeps parsed inventory in memory and local disk, revalidated by etag
+
+    # resources required by process_df, used by ld.chain
+    required_resource_keys: ClassVar[set] = {"minio"}
 
     def create_asset(self) -> AssetsDefinition:
         @asset(
             description="Injects values from S3 file",
             kinds=["Minio", "Python"],
-            required_resource_keys={'minio'},
+            required_resource_keys=self.required_resource_keys,
             **self.asset_args
         )
         def inject(context:OpExecutionContext, data:list[dict]) -> list[dict]:
-            inventory = context.resources.minio.get_obj(self.minio.bucket, self.minio.file_name)
-            df = pd.read_csv(inventory)
-            print(df)
-            for obj in data:
-                obj_source = obj.get(self.key)
-                try:
-                    row = df.loc[df[self.csv_key] == int(obj_source)]
-                except ValueError:
-                    row = df.loc[df[self.csv_key] == obj_source]
-                inject_values(row, obj)
-
-            print(data)
-            return data
-
-        def inject_values(row:pd.Series, obj:dict):
-            """
-            Injects values to dictionary from series
-            """
-            if row.empty:
+            df, metadata = self.process_df(context, pd.DataFrame(data))
+            context.add_output_metadata(metadata)
+            # NaN is not valid JSON, missing values are returned as None
+            return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+        return inject
+
+    def process_df(self, context:OpExecutionContext, df:pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+        """
+        Injects inventory values to the dataframe with single left join, returns dataframe and join metadata
+        """
+        inventory, source = self.__get_inventory(context)
+        lookup, duplicates = inventory.lookup(self.csv_key)
+        df, metadata = left_join_values(df, self.key, lookup, self.inject_values)
+        metadata.update({"inventory_duplicates": duplicates, "inventory_source": source})
+        if metadata["unmatched_rows"]:
+            context.log.warning(f"{metadata['unmatched_keys']} keys not found in inventory: {metadata['unmatched_keys_sample']}")
+        return df, metadata
+
+    def __get_inventory(self, context:OpExecutionContext) -> tuple[Inventory, str]:
+        if self.cache:
+            return get_inventory(context.resources.minio, self.minio.bucket, self.minio.file_name)
+        inventory = context.resources.minio.get_obj(self.minio.bucket, self.minio.file_name)
+        return Inventory(read_csv_file(inventory)), "download"
+
+
+@registry.register_module('s3.merge_inventory')
+class merge_inventory(ModuleBase):
+    """
+    Merges changed objects into keyed inventory CSV file in the bucket and stores the last sync time,
+    that is used by http_get delta. Without stored sync time or when http_get delta of the same run requested
+    all objects the inventory is replaced (full sync)
+    """
+    minio: Minio
+    state: str # state object in the same bucket
+    key: str = "id"
+    updated: str = "last_updated" # column with object update time
+    deletions: Optional[Deletions] = None
+
+    def create_asset(self) -> AssetsDefinition:
+        @asset(
+            description="Merges changed objects into inventory",
+            kinds=["Minio", "pandas"],
+            required_resource_keys={"minio"},
+            **self.asset_args
+        )
+        @timed_asset
+        def merge_inventory(context:OpExecutionContext, data:list[dict]) -> None:
+            minio = context.resources.minio
+            if not data:
+                context.log.info("No changed objects")
+                context.add_output_metadata({"inserted": 0, "updated": 0, "deleted": 0})
                 return
-            for key, value in self.inject_values.items():
-                obj[value] = row.iloc[0][key]
-        
-        return inject
\ No newline at end of file
+
+            changes = pd.DataFrame(data)
+            updated = pd.to_datetime(changes[self.updated], utc=True, format="ISO8601")
+            changes = changes.loc[updated.sort_values(kind="stable", na_position="first").index].reset_index(drop=True)
+            since = changes[self.updated].iloc[-1]
+
+            state = read_json_obj(minio, self.minio.bucket, self.state)
+            # http_get delta marks due full sync with its run id
+            full_sync = not state.get("since") or state.get("full_sync_run") == context.run_id
+            inventory = pd.DataFrame() if full_sync else self.__read_inventory(minio)
+            merged, metadata = merge_changes(inventory, changes, self.key, self.__deleted(changes))
+
+            minio.upload_obj(self.minio.bucket, self.minio.file_name, merged.to_csv(index=False).encode("utf-8"))
+            # state is written after inventory, failed run requests the same changes again
+            full_sync_at = datetime.now(timezone.utc).isoformat() if full_sync else state.get("full_sync_at")
+            new_state = {"since": since, "rows": metadata["rows"], "full_sync_at": full_sync_at}
+            minio.upload_obj(self.minio.bucket, self.state, json.dumps(new_state).encode("utf-8"))
+            context.add_output_metadata({**metadata, "full_sync": full_sync, "since": str(since)})
+        return merge_inventory
+
+    def __read_inventory(self, minio) -> pd.DataFrame:
+        try:
+            inventory, _ = get_inventory(minio, self.minio.bucket, self.minio.file_name)
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchBucket"):
+                return pd.DataFrame()
+            raise
+        return inventory.df
+
+    def __deleted(self, changes:pd.DataFrame) -> pd.Series:
+        """
+        Returns mask of changed objects, that should be removed from inventory
+        """
+        if not self.deletions:
+            return pd.Series(False, index=changes.index)
+        if self.deletions.column not in changes:
+            return pd.Series(self.deletions.missing, index=changes.index)
+        column = changes[self.deletions.column]
+        return column.isin(self.deletions.values) | (column.isna() & self.deletions.missing)
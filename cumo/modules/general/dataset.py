@@ -0,0 +1,81 @@
+import io
+import json
+from typing import Iterable, Optional
+from urllib.parse import quote, unquote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST_FOLDER = "_manifests" # one manifest per asset partition run in the dataset folder
+UNKNOWN_DATE = "unknown" # date partition of rows without valid timestamp
+
+
+def partition_path(folder:str, date:str, element:Optional[str]) -> str:
+    """
+    Returns hive style partition folder, values are quoted so they can not break the path
+    """
+    path = f"{folder}/date={quote(date, safe='')}"
+    if element is not None:
+        path += f"/element={quote(str(element), safe='')}"
+    return path
+
+
+def parse_partition(folder:str, file_name:str) -> dict:
+    """
+    Returns partition values (date, element) of the file in the dataset folder
+    """
+    parts = file_name[len(folder):].strip("/").split("/")[:-1]
+    return {key: unquote(value) for key, _, value in (part.partition("=") for part in parts)}
+
+
+def split_partitions(df:pd.DataFrame, time_col:str, element_col:Optional[str]) -> Iterable[tuple[str, Optional[str], pd.DataFrame]]:
+    """
+    Splits dataframe to (date, element, rows) partitions by UTC date of time column and element column.
+    Rows without valid timestamp are in the unknown date partition
+    """
+    dates = df[time_col].dt.strftime("%Y-%m-%d").fillna(UNKNOWN_DATE)
+    keys = [dates, df[element_col].astype(str)] if element_col else [dates]
+    for key, rows in df.groupby(keys, sort=False, dropna=False):
+        yield key[0], key[1] if element_col else None, rows
+
+
+def to_parquet_bytes(df:pd.DataFrame, compression:str) -> bytes:
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, compression=compression)
+    return buffer.getvalue()
+
+
+def manifest_name(folder:str, part:str) -> str:
+    return f"{folder}/{MANIFEST_FOLDER}/{part}.json"
+
+
+def file_stats(df:pd.DataFrame, time_col:str) -> dict:
+    """
+    Returns row count and min/max timestamps of the file, timestamps are None without valid values
+    """
+    times = df[time_col].dropna()
+    return {
+        "rows": df.shape[0],
+        "min": times.min().isoformat() if not times.empty else None,
+        "max": times.max().isoformat() if not times.empty else None,
+    }
+
+
+def create_manifest(part:str, files:dict, columns:list) -> bytes:
+    """
+    Manifest lists all files written by one asset partition run with their stats, readers do not list parquet files
+    """
+    return json.dumps({"part": part, "columns": columns, "files": files}).encode("utf-8")
+
+
+def in_range(value:str, start:Optional[str], end:Optional[str]) -> bool:
+    return (start is None or value >= start) and (end is None or value <= end)
+
+
+def overlaps(stats:dict, start:Optional[pd.Timestamp], end:Optional[pd.Timestamp]) -> bool:
+    """
+    Checks if time range of the file stats overlaps requested time range, files without timestamps never overlap
+    """
+    if stats["min"] is None:
+        return start is None and end is None
+    return (start is None or pd.Timestamp(stats["max"]) >= start) and (end is None or pd.Timestamp(stats["min"]) <= end)
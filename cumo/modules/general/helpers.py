@@ -1,30 +1,128 @@
 import csv
+import gzip
+import io
 from io import StringIO
+import multiprocessing
 import os
-from typing import List
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, List, Optional
 import pandas as pd
 from dagster import MetadataValue, OpExecutionContext, get_dagster_logger
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 logger = get_dagster_logger()
 
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def check_compression(compression:Optional[str]) -> None:
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires zstandard package")
+
 
-def convert_to_stream(data:list[dict]) -> StringIO:
-    buffer = StringIO()
-    writer = csv.DictWriter(buffer, fieldnames=data[0].keys())
-    writer.writeheader()  # Write column headers
-    writer.writerows(data) 
-    buffer.seek(0)
-    return buffer
+def create_compressor(compression:Optional[str]):
+    if compression == "gzip":
+        # wbits 31 writes gzip header and trailer
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return None
 
 
-def write_to_csv_file(file_name:str, data:list[dict]) -> None:
+class CsvStream(io.RawIOBase):
+    """
+    Read only file object, that encodes rows to CSV chunk by chunk and optionally compresses them.
+    Only one chunk of rows is kept encoded in memory, used for uploads with unknown length
+    """
+    def __init__(self, rows:Iterable[dict], fieldnames:list, compression:Optional[str] = None, header:bool = True, chunk_rows:int = 5000):
+        self.rows = iter(rows)
+        self.fieldnames = fieldnames
+        self.compressor = create_compressor(compression)
+        self.header = header
+        self.chunk_rows = chunk_rows
+        self.buffer = bytearray()
+        self.done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def __encode_chunk(self) -> bytes:
+        text = StringIO()
+        writer = csv.DictWriter(text, fieldnames=self.fieldnames)
+        if self.header:
+            writer.writeheader()
+            self.header = False
+        for _, row in zip(range(self.chunk_rows), self.rows):
+            writer.writerow(row)
+        return text.getvalue().encode("utf-8")
+
+    def read(self, size:int = -1) -> bytes:
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.__encode_chunk()
+            if not chunk:
+                self.done = True
+                if self.compressor:
+                    self.buffer += self.compressor.flush()
+                break
+            self.buffer += self.compressor.compress(chunk) if self.compressor else chunk
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def open_csv(obj) -> io.IOBase:
+    """
+    Returns readable CSV stream for the seekable file object, gzip and zstd compressed files are detected
+    by magic bytes and decompressed transparently
+    """
+    magic = obj.read(4)
+    obj.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=obj)
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("zstd compressed CSV requires zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(obj)
+    return obj
+
+
+def read_csv_file(obj, **kwargs) -> pd.DataFrame:
+    """
+    Reads CSV from file object or local file name, compressed files are decompressed transparently
+    """
+    if isinstance(obj, str):
+        with open(obj, "rb") as file:
+            return pd.read_csv(open_csv(file), **kwargs)
+    return pd.read_csv(open_csv(obj), **kwargs)
+
+
+def group_by_key(data:list[dict], key:str) -> dict[str, list[dict]]:
+    """
+    Groups list of dictionaries by value of the key, keeps order of rows inside groups
+    """
+    groups = {}
+    for obj in data:
+        groups.setdefault(obj.get(key), []).append(obj)
+    return groups
+
+def write_to_csv_file(file_name:str, data:list[dict], compression:Optional[str] = None) -> None:
+    """
+    Appends rows to the local CSV file, compressed rows are appended as new gzip member or zstd frame
+    """
     is_file = os.path.exists(file_name)
-    with open(file_name, mode="a", newline="") as file:
-        writer = csv.DictWriter(file, data[0].keys())
-        if not is_file:
-            writer.writeheader()  # Write column headers
-        writer.writerows(data)  
+    stream = CsvStream(data, list(data[0].keys()), compression, header=not is_file)
+    with open(file_name, mode="ab") as file:
+        while chunk := stream.read(1024 * 1024):
+            file.write(chunk)
 
 def read_csvs_from_local_pd(file_names:list[str], pk:dict) -> list[pd.DataFrame]:
     files = []
@@ -32,24 +130,99 @@ def read_csvs_from_local_pd(file_names:list[str], pk:dict) -> list[pd.DataFrame]
         file_name = file_name.format(**pk)
         logger.info(file_name)
         try:
-            files.append(pd.read_csv(file_name))
+            files.append(read_csv_file(file_name))
         except Exception as e:
             logger.log.info(e)
             continue      
     return files
 
 def read_csvs_from_minio(file_names:list[str],bucket:str, context:OpExecutionContext, pk:dict) -> list[pd.DataFrame]:
-    files = []
-    for file_name in file_names:
+    file_names = [file_name.format(**pk) for file_name in file_names]
+    return read_csvs_concurrently(context.resources.minio, bucket, file_names)
+
+
+class ByteBudget:
+    """
+    Limits bytes in flight, acquire blocks until requested bytes fit into the limit.
+    Object larger than the limit is allowed, when nothing else is in flight
+    """
+    def __init__(self, limit:int):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size:int) -> None:
+        with self.condition:
+            self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def release(self, size:int) -> None:
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+# forkserver is not available on Windows
+PROCESS_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def parse_csv_bytes(data:bytes) -> pd.DataFrame:
+    return read_csv_file(io.BytesIO(data))
+
+
+def parse_csv_in_process(processes:ProcessPoolExecutor, data:bytes) -> pd.DataFrame:
+    """
+    Decompresses CSV in the calling thread and parses it in the process pool. Workers get pandas.read_csv as the task,
+    importing anything from cumo would run cumo/__init__.py and build all pipeline definitions in every worker
+    """
+    with open_csv(io.BytesIO(data)) as stream:
+        content = stream.read()
+    return processes.submit(pd.read_csv, io.BytesIO(content)).result()
+
+
+def read_csvs_concurrently(minio, bucket:str, file_names:list[str], concurrency:int = 8, max_inflight_bytes:int = 256 * 1024 * 1024,
+                           parse_processes:int = 0, large_file_bytes:int = 32 * 1024 * 1024) -> list[pd.DataFrame]:
+    """
+    Downloads and parses CSV files with thread pool, files larger than large_file_bytes are parsed in process pool.
+    Downloaded and not parsed bytes are limited by max_inflight_bytes. Missing or broken files are logged and skipped,
+    dataframes are returned in the order of file names
+    """
+    budget = ByteBudget(max_inflight_bytes)
+    processes = None
+    if parse_processes:
+        # forking a process with running threads can copy held locks, workers start from a clean process instead
+        processes = ProcessPoolExecutor(parse_processes, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+
+    def read(file_name:str) -> Optional[pd.DataFrame]:
+        logger.info(file_name)
         try:
-            file_name = file_name.format(**pk)
-            logger.info(file_name)
-            res = context.resources.minio.get_obj(bucket, file_name)
-            files.append(pd.read_csv(res))
+            response = minio.get_stream(bucket, file_name)
         except Exception as e:
-            context.log.info(e)
-            continue
-    return files
+            logger.info(f"{file_name}: {e}")
+            return None
+        size = int(response.headers.get("Content-Length") or 0)
+        budget.acquire(size)
+        try:
+            try:
+                data = response.read()
+            finally:
+                response.close()
+                response.release_conn()
+            if processes and size >= large_file_bytes:
+                return parse_csv_in_process(processes, data)
+            return parse_csv_bytes(data)
+        except Exception as e:
+            logger.info(f"{file_name}: {e}")
+            return None
+        finally:
+            budget.release(size)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as threads:
+            return [df for df in threads.map(read, file_names) if df is not None]
+    finally:
+        if processes:
+            processes.shutdown()
 
 
 
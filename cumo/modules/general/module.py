@@ -1,11 +1,17 @@
 from typing import List, Literal, Optional
+import json
+import time
+from urllib.parse import quote
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dagster import MetadataValue, OpExecutionContext, asset, AssetsDefinition
 from pydantic import BaseModel
 from dagster_factory_pipelines import ModuleBase
 from dagster_factory_pipelines.factory.base import ModuleBase
-from dagster_factory_pipelines.factory.registry import register_module
-from .helpers import convert_to_stream, read_csvs_from_local_pd, read_csvs_from_minio, write_to_csv_file, remove_duplicates, remove_timeseries_duplicates, drop_columns
+from dagster_factory_pipelines.factory.registry import get_module, register_module
+from .helpers import CsvStream, check_compression, group_by_key, read_csv_file, read_csvs_concurrently, read_csvs_from_local_pd, read_csvs_from_minio, write_to_csv_file, remove_duplicates, remove_timeseries_duplicates, drop_columns
+from .dataset import MANIFEST_FOLDER, UNKNOWN_DATE, create_manifest, file_stats, in_range, manifest_name, overlaps, parse_partition, partition_path, split_partitions, to_parquet_bytes
 from ...utils.utils import df_info, df_rows, timed_asset, asset_len
 class TimeSeriesDuplicate(BaseModel):
     base_col:str
@@ -14,10 +20,28 @@ class TimeSeriesDuplicate(BaseModel):
 class Minio(BaseModel):
     bucket: str
 
+class DateRange(BaseModel):
+    start: Optional[str] = None # YYYY-mm-dd, supports pk syntax
+    end: Optional[str] = None
+
+class TimeRange(BaseModel):
+    start: Optional[str] = None # ISO timestamp, without timezone UTC is used
+    end: Optional[str] = None
+
+class ChainStep(BaseModel):
+    module: str # registered module name, such as dict.remove_duplicates
+    name: Optional[str] = None # prefix of the step metadata, defaults to module
+    params: dict = {}
+
 class ReadAll(BaseModel):
     #key:str
-    elements: List[str]
+    elements: Optional[List[str]] = None
+    prefix: Optional[str] = None # reads all objects under the prefix instead of elements, supports pk syntax
     save: Optional[str] = None
+    concurrency: int = 8 # files downloaded at once
+    max_inflight_bytes: int = 256 * 1024 * 1024 # downloaded and not parsed bytes
+    parse_processes: int = 0 # processes for parsing large files, 0 parses in download threads
+    large_file_bytes: int = 32 * 1024 * 1024 # files parsed in processes
 
 @register_module("write_to_csv")
 class write_to_csv(ModuleBase):
@@ -28,8 +52,12 @@ class write_to_csv(ModuleBase):
     """
     minio: Optional[Minio] = None
     file_name: str
+    split_by: Optional[str] = None # key used as {static} in file_name, writes one file per value
+    compression: Optional[Literal["gzip", "zstd"]] = None
+    part_size: int = 10 * 1024 * 1024 # size of multipart upload parts, at least 5 MiB
 
     def create_asset(self) -> AssetsDefinition:
+            check_compression(self.compression)
             @asset(
             description="Writes list of dictionaries to the csv",
             compute_kind="CSV",
@@ -39,18 +67,40 @@ class write_to_csv(ModuleBase):
             @timed_asset
             def write_to_csv(context:OpExecutionContext, data:list[dict]) -> None:
                 context.log.info(data)
-                if self.partition:
-                    pk = context.partition_key.keys_by_dimension
-                    self.file_name = self.file_name.format(**pk)
-
-                if self.minio:
-                    buffer = convert_to_stream(data)
-                    context.resources.minio.upload_obj(self.minio.bucket, self.file_name, buffer)
+                self.create_pk(context)
+
+                if self.split_by:
+                    # split value is {static}, create_pk stores hourly and weekly keys as static
+                    pk = self.pk if "date" in self.pk or not self.partition else {"date": context.partition_key}
+                    files = {self.file_name.format(**dict(pk, static=static)): rows for static, rows in group_by_key(data, self.split_by).items()}
+                    if self.minio:
+                        streams = {file_name: self.__stream(rows) for file_name, rows in files.items()}
+                        context.resources.minio.upload_objs(self.minio.bucket, streams, part_size=self.part_size)
+                        return
+                    for file_name, rows in files.items():
+                        write_to_csv_file(file_name, rows, self.compression)
                     return
 
-                write_to_csv_file(self.file_name, data)
+                file_name = self.file_name.format(**self.pk) if self.partition else self.file_name
+                self.__write(context, file_name, data)
             return write_to_csv 
 
+    def __write(self, context:OpExecutionContext, file_name:str, data:list[dict]) -> None:
+        """
+        Writes data to the bucket if minio is configured, otherwise to the local file
+        """
+        if self.minio:
+            context.resources.minio.upload_obj(self.minio.bucket, file_name, self.__stream(data), self.part_size)
+            return
+
+        write_to_csv_file(file_name, data, self.compression)
+
+    def __stream(self, data:list[dict]) -> CsvStream:
+        """
+        Returns CSV stream, rows are encoded and compressed while the stream is uploaded
+        """
+        return CsvStream(data, list(data[0].keys()), self.compression)
+
 @register_module("read_csv")
 class read_csv(ModuleBase):
 
@@ -71,6 +121,9 @@ class read_csv(ModuleBase):
             
             Returns dataframe 
             """
+            if self.read_all and not (self.read_all.elements or self.read_all.prefix):
+                raise ValueError("read_all requires elements or prefix")
+
             @asset(
             description="Extract data",
             compute_kind="CSV",
@@ -96,21 +149,29 @@ class read_csv(ModuleBase):
 
     def __read_all_bucket_files(self, context:OpExecutionContext) -> list:
         """
-        Reads all files from the S3 bucket, if real_all.elements present.
+        Reads all element files or all files under the prefix from the S3 bucket concurrently.
         This method creates dataframe for each read CSV and returns a list of dataframes
         """
         context.log.info("Reading all files")
-        files = []
-        for el in self.read_all.elements:
-            file_name = self.file_name.format(key=el, **self.pk)
-            context.log.info(file_name)
-            try:
-                res = context.resources.minio.get_obj(self.minio.bucket, file_name)
-                files.append(pd.read_csv(res))
-            except Exception as e:
-                context.log.info(e)
-                continue
+        read_all = self.read_all
+        if read_all.prefix:
+            save = read_all.save.format(**self.pk) if read_all.save else None
+            objs = context.resources.minio.list_objs(self.minio.bucket, read_all.prefix.format(**self.pk))
+            file_names = [obj.object_name for obj in objs if obj.object_name != save]
+        else:
+            file_names = [self.file_name.format(key=el, **self.pk) for el in read_all.elements]
+        files = read_csvs_concurrently(
+            context.resources.minio,
+            self.minio.bucket,
+            file_names,
+            concurrency=read_all.concurrency,
+            max_inflight_bytes=read_all.max_inflight_bytes,
+            parse_processes=read_all.parse_processes,
+            large_file_bytes=read_all.large_file_bytes,
+        )
+        context.add_output_metadata({"files_read": len(files), "files_requested": len(file_names)})
         return files
+
     def __remove_timeseries_duplicates(self) -> None:
         """
         Remove timeseries duplicates from the dataframe. TimeSeries duplicate are rows that how different timestamp, but
@@ -145,12 +206,12 @@ class read_csv(ModuleBase):
         """
         self.file_name = self.file_name.format(**self.pk)
         res = context.resources.minio.get_obj(self.minio.bucket, self.file_name)
-        self.df = pd.read_csv(res)
+        self.df = read_csv_file(res)
 
     def __read_csv_from_local(self, context:OpExecutionContext) -> None:
         self.file_name = self.file_name.format(**self.pk)
         context.log.info("reading csv from localfiles")
-        self.df = pd.read_csv(
+        self.df = read_csv_file(
             self.file_name,
             sep=","
             )
@@ -351,20 +412,26 @@ class Aggregator2(ModuleBase):
         )
         @asset_len
         def agg(context: OpExecutionContext, data:list[dict]) -> list[dict]:
-            # GPT solution modified
             df = pd.DataFrame(data)
             context.log.info(df)
-            df[self.date] = pd.to_datetime(df[self.date])
-            df.set_index(self.date, inplace=True)
-            cols = list(df.columns)
-            cols.remove(self.value)
-            result = (
-                df.groupby([pd.Grouper(freq=self.freq), *cols])
-                .agg({self.value: self.value_agg_method})
-                .reset_index()
-            )
+            result, _ = self.process_df(context, df)
             return  result.to_dict(orient="records")
         return agg
+
+    def process_df(self, context:OpExecutionContext, df:pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+        """
+        Aggregates dataframe values by date, returns dataframe and metadata. Used by asset and ld.chain
+        """
+        # GPT solution modified
+        df = df.assign(**{self.date: pd.to_datetime(df[self.date])}).set_index(self.date)
+        cols = list(df.columns)
+        cols.remove(self.value)
+        result = (
+            df.groupby([pd.Grouper(freq=self.freq), *cols])
+            .agg({self.value: self.value_agg_method})
+            .reset_index()
+        )
+        return result, {}
     
 @register_module("ld.pandas_ops")
 class pandas_ops2(ModuleBase):
@@ -385,4 +452,211 @@ class pandas_ops2(ModuleBase):
                 exec(command)
             context.log.info(df)
             return df.to_dict(orient="records")
-        return pandas_ops
\ No newline at end of file
+        return pandas_ops
+
+@register_module("ld.chain")
+class chain(ModuleBase):
+    """
+    Runs sequence of list of dictionaries modules in one asset on a single dataframe,
+    without IO manager writes and dictionary conversions between the steps.
+
+    Step modules should implement process_df, the last one can implement finalize_df instead.
+    """
+    steps: List[ChainStep]
+
+    def create_asset(self) -> AssetsDefinition:
+        modules = self.__create_modules()
+        resources = set().union(*(getattr(module, "required_resource_keys", set()) for module in modules))
+
+        @asset(
+        description="Runs sequence of modules on a single dataframe",
+        compute_kind="pandas",
+        required_resource_keys=resources or None,
+        **self.asset_args
+        )
+        @asset_len
+        @timed_asset
+        def chain(context:OpExecutionContext, data:list[dict]) -> list:
+            df = pd.DataFrame(data)
+            res = None
+            metadata = {}
+            for step, module in zip(self.steps, modules):
+                name = step.name or step.module
+                start_time = time.time()
+                if hasattr(module, "process_df"):
+                    df, step_metadata = module.process_df(context, df)
+                    rows = df.shape[0]
+                else:
+                    res = module.finalize_df(context, df)
+                    step_metadata, rows = {}, len(res)
+                step_metadata.update({"rows": rows, "duration": time.time() - start_time})
+                metadata.update({f"{name}/{key}": value for key, value in step_metadata.items()})
+            context.add_output_metadata(metadata)
+            return res if res is not None else df.to_dict(orient="records")
+        return chain
+
+    def __create_modules(self) -> list[ModuleBase]:
+        """
+        Creates step modules from the registry and checks they can be chained
+        """
+        names = [step.name or step.module for step in self.steps]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Chain {self.asset_name} step names should be unique, provide name for repeated modules")
+
+        modules = []
+        for index, step in enumerate(self.steps):
+            module = get_module(step.module, {"asset_name": f"{self.asset_name}_{index}", "partition": self.partition, **step.params})
+            last = index == len(self.steps) - 1
+            if not hasattr(module, "process_df") and not (last and hasattr(module, "finalize_df")):
+                raise ValueError(f"Module {step.module} can not be used in chain {self.asset_name}")
+            modules.append(module)
+        return modules
+
+
+@register_module("write_to_dataset")
+class write_to_dataset(ModuleBase):
+    """
+    Writes list of dictionaries to hive style partitioned parquet dataset in the bucket (folder/date=…/element=…).
+    Files are named by asset partition and listed with row count and min/max timestamps in one manifest of the partition,
+    so rerun of the partition replaces its files. Rows without valid timestamp are written to date=unknown
+    """
+    minio: Minio
+    folder: str # supports pk syntax
+    time_col: str # timestamps, stored as UTC timestamps and used for date partitions
+    element_col: Optional[str] = None # element partitions, if not set only dates are used
+    compression: str = "zstd"
+
+    def create_asset(self) -> AssetsDefinition:
+        @asset(
+        description="Writes list of dictionaries to partitioned parquet dataset",
+        compute_kind="parquet",
+        required_resource_keys={"minio"},
+        **self.asset_args
+        )
+        @timed_asset
+        def write_to_dataset(context:OpExecutionContext, data:list[dict]) -> None:
+            if not data:
+                context.log.info("No rows to write")
+                return
+            self.create_pk(context)
+            df = pd.DataFrame(data)
+            df[self.time_col] = pd.to_datetime(df[self.time_col], utc=True, format="ISO8601")
+
+            folder = self.folder.format(**self.pk)
+            part = f"part-{quote(str(context.partition_key), safe='')}" if context.has_partition_key else "part-all"
+            minio, bucket = context.resources.minio, self.minio.bucket
+            objs, files, unknown = {}, {}, 0
+            for date, element, rows in split_partitions(df, self.time_col, self.element_col):
+                unknown += rows.shape[0] if date == UNKNOWN_DATE else 0
+                file_name = f"{partition_path(folder, date, element)}/{part}.parquet"
+                objs[file_name] = to_parquet_bytes(rows, self.compression)
+                files[file_name] = file_stats(rows, self.time_col)
+
+            previous = minio.get_objs(bucket, [manifest_name(folder, part)], missing_ok=True)
+            minio.upload_objs(bucket, objs)
+            # manifest is written after files, readers see only complete runs
+            minio.upload_obj(bucket, manifest_name(folder, part), create_manifest(part, files, list(df.columns)))
+            stale = [file_name for obj in previous.values() for file_name in json.load(obj)["files"] if file_name not in files]
+            for file_name in stale:
+                minio.remove_obj(bucket, file_name)
+
+            if unknown:
+                context.log.warning(f"{unknown} rows without valid {self.time_col} written to date={UNKNOWN_DATE}")
+            context.add_output_metadata({
+                "partitions": len(files),
+                "rows": sum(stats["rows"] for stats in files.values()),
+                "unknown_time_rows": unknown,
+                "stale_files_removed": len(stale),
+            })
+        return write_to_dataset
+
+
+@register_module("read_dataset")
+class read_dataset(ModuleBase):
+    """
+    Reads partitioned parquet dataset written by write_to_dataset to dataframe. Files are found from manifests,
+    partitions are pruned by dates and elements, files by manifest time ranges, only required columns are read
+    """
+    minio: Minio
+    folder: str # supports pk syntax
+    dates: Optional[DateRange] = None
+    elements: Optional[List[str]] = None
+    time: Optional[TimeRange] = None
+    time_col: Optional[str] = None # required for time filter
+    columns: Optional[List[str]] = None
+    concurrency: int = 8
+
+    def create_asset(self) -> AssetsDefinition:
+        if self.time and not self.time_col:
+            raise ValueError("read_dataset time filter requires time_col")
+
+        @asset(
+        description="Reads partitioned parquet dataset",
+        compute_kind="parquet",
+        required_resource_keys={"minio"},
+        **self.asset_args
+        )
+        @timed_asset
+        @df_rows
+        def read_dataset(context:OpExecutionContext) -> pd.DataFrame:
+            self.create_pk(context)
+            minio, bucket = context.resources.minio, self.minio.bucket
+            folder = self.folder.format(**self.pk)
+
+            # files are known from manifests of partition runs, parquet files are not listed
+            names = [obj.object_name for obj in minio.list_objs(bucket, f"{folder}/{MANIFEST_FOLDER}/") if obj.object_name.endswith(".json")]
+            manifests = minio.get_objs(bucket, names, self.concurrency, missing_ok=True)
+            stats = {file_name: file for obj in manifests.values() for file_name, file in json.load(obj)["files"].items()}
+            start, end, filters = self.__time_filter()
+            files = [file_name for file_name in stats if self.__keep_partition(parse_partition(folder, file_name), start, end)]
+            partition_files = len(files)
+            if self.time:
+                files = [file_name for file_name in files if overlaps(stats[file_name], start, end)]
+
+            objs = minio.get_objs(bucket, files, self.concurrency)
+            tables = [pq.read_table(objs[file_name], columns=self.columns, filters=filters) for file_name in files]
+            df = pa.concat_tables(tables, promote_options="default").to_pandas() if tables else pd.DataFrame(columns=self.columns)
+            context.add_output_metadata({
+                "manifests": len(manifests),
+                "files_total": len(stats),
+                "files_after_partition_pruning": partition_files,
+                "files_read": len(files),
+            })
+            return df
+        return read_dataset
+
+    def __keep_partition(self, partition:dict, start:Optional[pd.Timestamp], end:Optional[pd.Timestamp]) -> bool:
+        """
+        Checks partition against dates, elements and dates of the time range
+        """
+        date = partition.get("date", "")
+        if date == UNKNOWN_DATE:
+            # rows without timestamp are read only without date and time filters
+            return not (self.dates or start or end) and self.__keep_element(partition)
+        if (start or end) and not in_range(date, start and start.strftime("%Y-%m-%d"), end and end.strftime("%Y-%m-%d")):
+            return False
+        if self.dates and not in_range(date, self.__format(self.dates.start), self.__format(self.dates.end)):
+            return False
+        return self.__keep_element(partition)
+
+    def __keep_element(self, partition:dict) -> bool:
+        return not self.elements or partition.get("element") in [str(element) for element in self.elements]
+
+    def __format(self, value:Optional[str]) -> Optional[str]:
+        return value.format(**self.pk) if value else None
+
+    def __time_filter(self) -> tuple:
+        """
+        Returns time range as UTC timestamps and parquet row filters
+        """
+        if not self.time:
+            return None, None, None
+        start, end = (self.__timestamp(value) for value in (self.time.start, self.time.end))
+        filters = [(self.time_col, op, value) for op, value in ((">=", start), ("<=", end)) if value is not None]
+        return start, end, filters or None
+
+    def __timestamp(self, value:Optional[str]) -> Optional[pd.Timestamp]:
+        if not value:
+            return None
+        timestamp = pd.Timestamp(self.__format(value))
+        return timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC")
@@ -0,0 +1,164 @@
+import json
+import threading
+from functools import lru_cache
+from typing import Optional
+import jmespath
+from dagster import get_dagster_logger
+from .params import Decoder
+
+# fast decoders are optional, json module is used if they are not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+logger = get_dagster_logger()
+
+# simdjson parser can not be shared between threads
+PARSERS = threading.local()
+
+def check_decoder(decoder:Optional[Decoder]) -> None:
+    """
+    Warns if the configured decoder is not installed
+    """
+    if not decoder:
+        return
+    if (decoder.name == "orjson" and not orjson) or (decoder.name == "simdjson" and not simdjson):
+        logger.warning(f"{decoder.name} is not installed, json module is used for decoding")
+    check_projection(decoder)
+
+def decode(content:bytes, decoder:Optional[Decoder] = None):
+    """
+    Decodes json response content with the configured decoder and applies projection.
+    simdjson materializes only projected record keys, other decoders parse the whole document and drop keys after
+    """
+    name = decoder.name if decoder else "json"
+    projection = projection_fields(tuple(decoder.projection.mappings.values())) if decoder and decoder.projection else None
+
+    if name == "simdjson" and simdjson:
+        return decode_simdjson(content, projection)
+
+    data = orjson.loads(content) if name == "orjson" and orjson else json.loads(content)
+    if not projection:
+        return data
+    path, fields = projection
+    if path is None:
+        return [project_record(record, fields) for record in data]
+    if path in data:
+        data[path] = [project_record(record, fields) for record in data[path]]
+    return data
+
+# record fields are not known, whole records are kept
+ALL_FIELDS = None
+
+def union_fields(*fields):
+    if any(field is ALL_FIELDS for field in fields):
+        return ALL_FIELDS
+    return frozenset().union(*fields)
+
+def record_fields(node:dict):
+    """
+    Returns top level keys of the current value used by the jmespath AST node, ALL_FIELDS if the whole value is used
+    """
+    kind, children = node["type"], node["children"]
+    if kind == "field":
+        return frozenset([node["value"]])
+    if kind in ("literal", "index", "slice"):
+        return frozenset()
+    if kind in ("subexpression", "index_expression", "projection", "value_projection", "filter_projection", "flatten", "pipe"):
+        # the rest of the expression reads the result of the first child
+        if children[0]["type"] in ("identity", "current"):
+            return ALL_FIELDS
+        return record_fields(children[0])
+    if kind == "function_expression":
+        # expression references are applied to elements of other arguments, not to the current value
+        return union_fields(*[record_fields(child) for child in children if child["type"] != "expref"])
+    if kind in ("multi_select_list", "multi_select_dict", "key_val_pair", "or_expression", "and_expression", "not_expression", "comparator"):
+        return union_fields(*[record_fields(child) for child in children])
+    return ALL_FIELDS
+
+def page_records(node:dict):
+    """
+    Returns top level key with the records (None for the page itself) and the record AST node of the mapping
+    """
+    kind, children = node["type"], node["children"]
+    if kind == "pipe":
+        return page_records(children[0])
+    if kind in ("projection", "filter_projection"):
+        left, right = children[0], children[1]
+        if left["type"] == "identity":
+            path = None
+        elif left["type"] == "field":
+            path = left["value"]
+        else:
+            return None
+        if kind == "filter_projection":
+            # the condition reads the same records
+            return path, {"type": "multi_select_list", "children": [right, children[2]]}
+        return path, right
+    if kind == "function_expression" and node["value"] == "map" and children[1]["type"] in ("field", "current"):
+        path = children[1].get("value") if children[1]["type"] == "field" else None
+        return path, children[0]["children"][0]
+    return None
+
+@lru_cache(maxsize=None)
+def projection_fields(expressions:tuple) -> Optional[tuple]:
+    """
+    Computes the records key and the record keys used by json_mapper mappings from compiled jmespath ASTs.
+    Returns None if the mappings use whole records, records under different keys or read records without projection
+    """
+    path, fields = ..., frozenset()
+    for expression in expressions:
+        records = page_records(jmespath.compile(expression).parsed)
+        if records is None or (path is not ... and records[0] != path):
+            return None
+        path = records[0]
+        fields = union_fields(fields, record_fields(records[1]))
+        if fields is ALL_FIELDS:
+            return None
+    if path is ...:
+        return None
+    return path, fields
+
+def check_projection(decoder:Optional[Decoder]) -> None:
+    if decoder and decoder.projection and not projection_fields(tuple(decoder.projection.mappings.values())):
+        logger.warning("mappings use whole records, records are decoded without projection")
+
+def project_record(record, fields:frozenset):
+    if not isinstance(record, dict):
+        return record
+    return {key: value for key, value in record.items() if key in fields}
+
+def materialize(value):
+    """
+    Converts lazy simdjson value to python object
+    """
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+def project_simdjson_record(record, fields:frozenset):
+    if not isinstance(record, simdjson.Object):
+        return materialize(record)
+    return {key: materialize(record[key]) for key in record.keys() if key in fields}
+
+def decode_simdjson(content:bytes, projection:Optional[tuple]):
+    if not hasattr(PARSERS, "parser"):
+        PARSERS.parser = simdjson.Parser()
+    doc = PARSERS.parser.parse(content)
+    if not projection:
+        return materialize(doc)
+    path, fields = projection
+    if path is None:
+        return [project_simdjson_record(record, fields) for record in doc]
+    return {
+        key: [project_simdjson_record(record, fields) for record in doc[key]] if key == path else materialize(doc[key])
+        for key in doc.keys()
+    }
@@ -1,17 +1,64 @@
+import ast
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import operator
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable, Iterator, Optional
+from urllib.parse import urlparse
+import jmespath
+import pandas as pd
 import requests
 import requests.auth
-from .params import Auth
+from requests.adapters import HTTPAdapter
+from dagster import DagsterError, get_dagster_logger
+from dateutil.parser import isoparse
+from minio.error import S3Error
+from .params import Auth, Connection, Decoder, RateLimit
+from .decoders import decode
+from .limiter import RETRY_STATUSES, get_backoff, get_limiter, parse_retry_after
+from ...resources.resources import MinioBucket
+
+logger = get_dagster_logger()
+
+# keep-alive sessions shared by all requests to the same host in the process
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+def get_session(endpoint:str, pool_size:int) -> requests.Session:
+    """
+    Returns pooled keep-alive session for the endpoint host. Session is created once per host and pool size
+    """
+    key = (urlparse(endpoint).netloc, pool_size)
+    with SESSIONS_LOCK:
+        if key not in SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            SESSIONS[key] = session
+        return SESSIONS[key]
 
 class Request:
     """
     Class provides simplify API for python request lib
     """
-    def __init__(self, endpoint:str, variables:list, auth:Auth, params=None):
+    def __init__(self, endpoint:str, variables:list, auth:Auth, params=None, connection:Optional[Connection]=None, rate_limit:Optional[RateLimit]=None):
         self.endpoint = endpoint # endpoint of the url
         self.variables = variables # variables that can be injected to the url
         self.auth = auth # the auth method dict
         self.params = params # params ?
+        self.connection = connection if connection else Connection()
+        self.rate_limit = rate_limit if rate_limit else RateLimit()
         self.create_variable_based_endpoint()
+        self.session = get_session(self.endpoint, self.connection.pool_size)
+        self.limiter = get_limiter(self.endpoint, self.rate_limit)
         print(params, self.params)
 
     def create_variable_based_endpoint(self) -> None:
@@ -23,46 +70,324 @@ class Request:
 
     def get_data(self) -> requests.Response:
         """
-        Gets data from the endpoint in json format
+        Gets data from the endpoint in json format.
+        Requests go through the host limiter, throttled and failed requests are retried with backoff
         """
+        rate_limit = self.rate_limit
+        for attempt in range(rate_limit.retries + 1):
+            self.limiter.acquire()
+            # slot is always released, failed requests count as throttled
+            throttled, retry_after, error = True, None, None
+            try:
+                self.res = self.send()
+                throttled = self.res.status_code in RETRY_STATUSES
+                retry_after = parse_retry_after(self.res.headers.get("Retry-After")) if throttled else None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.limiter.release(throttled, retry_after)
+
+            if error:
+                if attempt == rate_limit.retries:
+                    raise error
+                time.sleep(get_backoff(rate_limit, attempt))
+                continue
+            if not throttled:
+                return self.res
+            if attempt == rate_limit.retries:
+                self.res.raise_for_status()
+            logger.info(f"{self.endpoint} responded with {self.res.status_code}, retry {attempt + 1}/{rate_limit.retries}")
+            time.sleep(retry_after if retry_after is not None else get_backoff(rate_limit, attempt))
+        return self.res
+
+    def get_json(self, decoder:Optional[Decoder] = None):
+        """
+        Gets data from the endpoint and decodes json with the configured decoder
+        """
+        return decode(self.get_data().content, decoder)
+
+    def send(self) -> requests.Response:
+        """
+        Sends get request with the configured auth method
+        """
+        timeout = (self.connection.connect_timeout, self.connection.read_timeout)
         if not self.auth:
-            self.res = requests.get(self.endpoint, params=self.params)
-            return self.res
+            return self.session.get(self.endpoint, params=self.params, timeout=timeout)
         
         if self.auth.basic_auth:
             auth_obj =self.auth.basic_auth
             username, password = auth_obj.username, auth_obj.password
-            self.res = requests.get(self.endpoint, params=self.params, auth=requests.auth.HTTPBasicAuth(username, password))
-            return self.res
+            return self.session.get(self.endpoint, params=self.params, auth=requests.auth.HTTPBasicAuth(username, password), timeout=timeout)
         
         if self.auth.bearer_token:
             headers = {"Authorization": f"Bearer {self.auth.bearer_token.token}"}
-            self.res = requests.get(self.endpoint, params=self.params, headers=headers)
-            return self.res
+            return self.session.get(self.endpoint, params=self.params, headers=headers, timeout=timeout)
 
         if self.auth.api_key:
             headers = {f"{self.auth.api_key.key_name}": f"{self.auth.api_key.key}"}
-            self.res = requests.get(self.endpoint, params=self.params, headers=headers)
-            return self.res
-
-
-
-def get_mapping_objs(mappings:dict) -> list:
-        keys = list(mappings.keys())
-        print(keys)
-        ls = []
-        if isinstance(mappings[keys[0]], list):
-            for index, obj in enumerate(mappings[keys[0]]):
-                if obj is None:
-                    continue
-                ob = dict()
-                ob[keys[0]] = obj
-                for key in keys[1:]:
-                    val =  mappings[key][index]
-                    if val is None:
-                        continue
-                    ob[key] = mappings[key][index]
-                ls.append(ob)
-
-            return ls
-        return mappings
\ No newline at end of file
+            return self.session.get(self.endpoint, params=self.params, headers=headers, timeout=timeout)
+
+
+# functions available in pagination conditions
+CONDITION_FUNCTIONS = {"len": len, "int": int, "float": float, "str": str, "bool": bool, "min": min, "max": max, "abs": abs}
+CONDITION_OPERATORS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+
+def compile_condition(condition:str) -> Callable[[dict], object]:
+    """
+    Compiles pagination condition such as "2000 == len(json_data['measurements'])" to a function of json_data.
+    Only comparisons, and/or/not, literals, json_data subscripts and CONDITION_FUNCTIONS are allowed, python code is never evaluated
+    """
+    try:
+        tree = ast.parse(condition.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid pagination condition {condition}: {e.msg}") from e
+    return compile_condition_node(tree.body, condition)
+
+def compile_condition_node(node:ast.AST, condition:str) -> Callable[[dict], object]:
+    if isinstance(node, ast.Constant) and (node.value is None or isinstance(node.value, (bool, int, float, str))):
+        value = node.value
+        return lambda json_data: value
+    if isinstance(node, ast.Name) and node.id == "json_data":
+        return lambda json_data: json_data
+    if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Constant):
+        target, key = compile_condition_node(node.value, condition), node.slice.value
+        return lambda json_data: target(json_data)[key]
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in CONDITION_FUNCTIONS and not node.keywords:
+        function = CONDITION_FUNCTIONS[node.func.id]
+        args = [compile_condition_node(arg, condition) for arg in node.args]
+        return lambda json_data: function(*[arg(json_data) for arg in args])
+    if isinstance(node, ast.Compare) and all(type(op) in CONDITION_OPERATORS for op in node.ops):
+        operands = [compile_condition_node(operand, condition) for operand in [node.left, *node.comparators]]
+        ops = [CONDITION_OPERATORS[type(op)] for op in node.ops]
+        def compare(json_data):
+            values = [operand(json_data) for operand in operands]
+            return all(op(a, b) for op, a, b in zip(ops, values, values[1:]))
+        return compare
+    if isinstance(node, ast.BoolOp):
+        values = [compile_condition_node(value, condition) for value in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda json_data: all(value(json_data) for value in values)
+        return lambda json_data: any(value(json_data) for value in values)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub)):
+        operand = compile_condition_node(node.operand, condition)
+        if isinstance(node.op, ast.Not):
+            return lambda json_data: not operand(json_data)
+        return lambda json_data: -operand(json_data)
+    raise ValueError(f"Unsupported {type(node).__name__} in pagination condition {condition}")
+
+def compile_predicate(condition:Optional[str], expression:Optional[str]) -> Callable[[dict], bool]:
+    """
+    Compiles pagination condition once. jmespath expression is used if provided, otherwise the comparison condition.
+    Without conditions predicate is always true
+    """
+    if expression:
+        compiled = jmespath.compile(expression)
+        return lambda json_data: bool(compiled.search(json_data))
+    if condition:
+        compiled_condition = compile_condition(condition)
+        return lambda json_data: bool(compiled_condition(json_data))
+    return lambda json_data: True
+
+def fetch_pages(fetch_page:Callable[[int], dict], pages:range, concurrency:int) -> Iterator[dict]:
+    """
+    Fetches pages from the range in parallel keeping up to concurrency requests in flight.
+    Pages are yielded in the same order as in the range
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = deque()
+        for page in pages:
+            futures.append(executor.submit(fetch_page, page))
+            if len(futures) == concurrency:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def probe_pages(fetch_page:Callable[[int], dict], has_more:Callable[[dict], bool], first_page:int, concurrency:int) -> Iterator[dict]:
+    """
+    Speculatively fetches up to concurrency pages ahead until a page without more data is found.
+    Pages after the last page are dropped, so the result is the same as for sequential pagination
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = deque(executor.submit(fetch_page, page) for page in range(first_page, first_page + concurrency))
+        next_page = first_page + concurrency
+        while True:
+            json_data = futures.popleft().result()
+            yield json_data
+            if not has_more(json_data):
+                for future in futures:
+                    future.cancel()
+                return
+            futures.append(executor.submit(fetch_page, next_page))
+            next_page += 1
+
+class PageSpool:
+    """
+    Pages spooled to the S3 bucket as gzip compressed JSON lines.
+    The object itself is small and can be stored by io manager, pages are read lazily one by one while iterating
+    """
+    def __init__(self, minio:dict, bucket:str, file_name:str, pages:int):
+        self.minio = minio # MinioBucket params, credentials are env variable names
+        self.bucket = bucket
+        self.file_name = file_name
+        self.pages = pages
+
+    def __len__(self) -> int:
+        return self.pages
+
+    def __iter__(self) -> Iterator[dict]:
+        res = MinioBucket(**self.minio).get_stream(self.bucket, self.file_name)
+        try:
+            with gzip.GzipFile(fileobj=res) as file:
+                for line in file:
+                    yield json.loads(line)
+        finally:
+            res.close()
+            res.release_conn()
+
+    def __repr__(self) -> str:
+        return f"PageSpool({self.bucket}/{self.file_name}, pages={self.pages})"
+
+def get_minio_params(minio:MinioBucket) -> dict:
+    """
+    Returns MinioBucket params that can be stored together with objects. Credentials are env variable names
+    """
+    return {"host": minio.host, "access_key": minio.access_key, "secret_key": minio.secret_key}
+
+def spool_pages(pages:Iterable[dict], minio:MinioBucket, bucket:str, file_name:str) -> PageSpool:
+    """
+    Writes pages one by one to a local gzip compressed file and uploads it to the bucket.
+    Only one page is kept in memory at once
+    """
+    count = 0
+    with tempfile.NamedTemporaryFile(suffix=".jsonl.gz") as tmp:
+        with gzip.GzipFile(fileobj=tmp, mode="wb") as file:
+            for page in pages:
+                file.write(json.dumps(page).encode("utf-8") + b"\n")
+                count += 1
+        tmp.flush()
+        minio.upload_file(bucket, file_name, tmp.name)
+    return PageSpool(get_minio_params(minio), bucket, file_name, count)
+
+class WatermarkTracker:
+    """
+    Passes through pages with records and keeps the latest record time found with jmespath path
+    """
+    def __init__(self, path:str, watermark:Optional[str] = None):
+        self.path = jmespath.compile(path)
+        self.watermark = watermark
+        self.pages = 0
+
+    def track(self, pages:Iterable[dict]) -> Iterator[dict]:
+        for page in pages:
+            times = self.path.search(page)
+            times = [time for time in (times if isinstance(times, list) else [times]) if time]
+            if not times:
+                continue
+            latest = max(times, key=isoparse)
+            if self.watermark is None or isoparse(latest) > isoparse(self.watermark):
+                self.watermark = latest
+            self.pages += 1
+            yield page
+
+def get_next_date_from(date_from:str, watermark:str) -> str:
+    """
+    Returns date from for the next incremental request. Watermark is moved by one millisecond, because date from is inclusive
+    """
+    next_date = isoparse(watermark) + timedelta(milliseconds=1)
+    if next_date <= isoparse(date_from):
+        return date_from
+    return next_date.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def get_archive_name(prefix:str, endpoint:str, params:Optional[dict]) -> str:
+    """
+    Returns content addressed archive object name for the endpoint and params
+    """
+    key = json.dumps({"endpoint": endpoint, "params": params or {}}, sort_keys=True, default=str)
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return f"{prefix}/{urlparse(endpoint).netloc}/{digest[:2]}/{digest}.json.gz"
+
+def archive_page(minio:MinioBucket, bucket:str, file_name:str, content:bytes) -> None:
+    """
+    Stores raw response content to the archive compressed with gzip
+    """
+    minio.upload_obj(bucket, file_name, gzip.compress(content))
+
+def read_archived_page(minio:MinioBucket, bucket:str, file_name:str, decoder:Optional[Decoder] = None) -> dict:
+    """
+    Reads archived response and decodes json. Missing pages fail the run, because replay mode does not use network
+    """
+    try:
+        content = minio.get_obj(bucket, file_name).getvalue()
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchBucket"):
+            raise DagsterError(f"Response is not archived: {file_name}") from e
+        raise
+    return decode(gzip.decompress(content), decoder)
+
+def full_sync_due(state:dict, full_sync_hours:Optional[float]) -> bool:
+    """
+    Checks if the last full sync stored in delta state is older than full_sync_hours
+    """
+    if full_sync_hours is None:
+        return False
+    full_sync_at = state.get("full_sync_at")
+    if not full_sync_at:
+        return True
+    return datetime.now(timezone.utc) - datetime.fromisoformat(full_sync_at) > timedelta(hours=full_sync_hours)
+
+
+def read_json_obj(minio:MinioBucket, bucket:str, file_name:str) -> dict:
+    """
+    Reads json object from the bucket, returns empty dict if the object does not exist
+    """
+    try:
+        return json.load(minio.get_obj(bucket, file_name))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchBucket"):
+            return {}
+        raise
+
+
+def map_page(compiled_mappings:dict, page, index:int) -> dict[str, list]:
+    """
+    Searches all compiled mappings in the page. Every mapping is a column of the page rows,
+    so all columns should have the same amount of values
+    """
+    columns = {}
+    for key, expression in compiled_mappings.items():
+        res = expression.search(page)
+        columns[key] = res if isinstance(res, list) else [res]
+    lengths = {key: len(values) for key, values in columns.items()}
+    if len(set(lengths.values())) > 1:
+        raise DagsterError(f"Mapped columns of page {index} are not aligned: {lengths}")
+    return columns
+
+# pandas dtypes for QuestDB column types, other types are kept as python objects
+QUESTDB_DTYPES = {
+    "BOOLEAN": "boolean",
+    "BYTE": "Int8",
+    "SHORT": "Int16",
+    "INT": "Int32",
+    "LONG": "Int64",
+    "FLOAT": "float32",
+    "DOUBLE": "float64",
+}
+
+def questdb_series(col_type:str, values:Iterable) -> pd.Series:
+    """
+    Creates typed series from QuestDB column values
+    """
+    col_type = col_type.upper()
+    if col_type in ("TIMESTAMP", "DATE"):
+        return pd.to_datetime(pd.Series(values, dtype=object), utc=True)
+    return pd.Series(values, dtype=QUESTDB_DTYPES.get(col_type, object))
+
+def questdb_frame(columns:list[dict], dataset:list[list]) -> pd.DataFrame:
+    """
+    Builds dataframe directly from QuestDB rows column by column, types are taken from QuestDB column metadata
+    """
+    values = list(zip(*dataset)) if dataset else [()] * len(columns)
+    return pd.DataFrame({col["name"]: questdb_series(col["type"], vals) for col, vals in zip(columns, values)})
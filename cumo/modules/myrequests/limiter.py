@@ -0,0 +1,106 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+from .params import RateLimit
+
+# status codes that are retried with backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# limiters shared by all requests to the same host in the process
+LIMITERS = {}
+LIMITERS_LOCK = threading.Lock()
+
+class HostLimiter:
+    """
+    Token bucket rate limiter with AIMD adaptive concurrency for one host.
+
+    The concurrency limit grows by one request per window of successful requests and is halved when the host
+    throttles or fails. Retry-After blocks all new requests to the host until the provided time.
+    """
+    def __init__(self, rate_limit:RateLimit):
+        self.rate = rate_limit.rate # tokens per second, no rate limit if None
+        self.burst = rate_limit.burst
+        self.max_concurrency = rate_limit.max_concurrency
+        self.tokens = float(rate_limit.burst)
+        self.updated = time.monotonic()
+        self.limit = float(rate_limit.max_concurrency) # current adaptive concurrency limit
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self) -> None:
+        """
+        Waits until the request can be sent
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wait = self.blocked_until - now
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    wait = self.__take_token(now)
+                    if wait <= 0:
+                        self.in_flight += 1
+                        return
+                self.cond.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, throttled:bool, retry_after:Optional[float] = None) -> None:
+        """
+        Releases the request slot and adapts concurrency limit based on the result
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.cond.notify_all()
+
+    def __take_token(self, now:float) -> float:
+        """
+        Takes token from the bucket. Returns 0 if token was taken, otherwise seconds until the next token
+        """
+        if not self.rate:
+            return 0
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+def get_limiter(endpoint:str, rate_limit:RateLimit) -> HostLimiter:
+    """
+    Returns limiter for the endpoint host. Limiter is created once per host with the first provided settings
+    """
+    host = urlparse(endpoint).netloc
+    with LIMITERS_LOCK:
+        if host not in LIMITERS:
+            LIMITERS[host] = HostLimiter(rate_limit)
+        return LIMITERS[host]
+
+def get_backoff(rate_limit:RateLimit, attempt:int) -> float:
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0, min(rate_limit.max_backoff, rate_limit.backoff * 2 ** attempt))
+
+def parse_retry_after(value:Optional[str]) -> Optional[float]:
+    """
+    Parses Retry-After header, which can be seconds or HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
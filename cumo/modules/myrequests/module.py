@@ -1,13 +1,24 @@
 
-from typing import Optional
-from dagster import AssetsDefinition, OpExecutionContext, asset
+from typing import Any, Callable, Iterator, List, Literal, Optional
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from itertools import chain
+import json
+import queue
+import threading
+from dagster import AssetsDefinition, DagsterError, OpExecutionContext, asset
 from pydantic import BaseModel
 from datetime import datetime, timezone
 
 from dagster_factory_pipelines import ModuleBase
 from dagster_factory_pipelines.factory.base import ModuleBase
 from dagster_factory_pipelines.factory.registry import register_module
-from .helpers import Request, get_mapping_objs
+from .helpers import (
+    PageSpool, Request, WatermarkTracker, archive_page, compile_predicate, fetch_pages, get_archive_name,
+    full_sync_due, get_minio_params, get_next_date_from, map_page, probe_pages, questdb_frame, read_archived_page, read_json_obj, spool_pages
+)
+from .params import Connection, Decoder, RateLimit
+from .decoders import check_decoder, decode
 
 from ...utils.utils import asset_len, timed_asset, df_info, get_range_based_on_type
 import pandas as pd
@@ -30,14 +41,57 @@ class Auth(BaseModel):
     bearer_token: Optional[BearerToken] = None
     api_key: Optional[APIKey] = None
 
+class TotalPages(BaseModel):
+    path: str # jmespath to the total pages count in the first response, e.g. statistics.totalPages
+    params: Optional[dict] = None # params added only to the first request, e.g. withTotalPages: true
+
 class CheckMore(BaseModel):
     condition: str
     parameter: str
+    concurrency: Optional[int] = None # fetches pages in parallel if set
+    total_pages: Optional[TotalPages] = None
+
+class Pagination(BaseModel):
+    strategy: Literal["page", "next_link", "cursor"] = "page"
+    parameter: Optional[str] = None # page counter or cursor parameter in the url
+    start: int = 1 # first page for page strategy
+    condition: Optional[str] = None # comparison condition with json_data, asks for more pages while true
+    jmespath: Optional[str] = None # jmespath condition, used instead of comparison condition
+    next_link: str = "next" # jmespath to the next page url for next_link strategy
+    cursor: Optional[str] = None # jmespath to the next cursor value for cursor strategy
+    concurrency: Optional[int] = None # page strategy only
+    total_pages: Optional[TotalPages] = None # page strategy only
 
 class Minio(BaseModel):
     bucket: str
     file_name: str
 
+class Spool(BaseModel):
+    bucket: str
+    file_name: str # supports pk syntax, e.g. spool/eco_counters/{date}/{static}.jsonl.gz
+
+class Incremental(BaseModel):
+    bucket: str
+    path: str # jmespath to record times in the page, e.g. measurements[*].time
+    prefix: str = "incremental" # folder for watermarks and stored partition pages
+
+class Delta(BaseModel):
+    bucket: str
+    state: str # state object with last sync time, written by s3.merge_inventory
+    parameter: str # request parameter, that receives last sync time
+    template: str = "{since}" # parameter value, {since} is replaced with last sync time
+    full_sync_hours: Optional[float] = None # all objects are requested when the last full sync is older, removed objects leave the inventory
+
+class Batch(BaseModel):
+    elements: List[str] # elements fetched in one run, sent as partition_mapping.elements parameter
+    concurrency: int = 4 # elements fetched at once
+    tag: str = "element" # key added to every page with the element value
+
+class Archive(BaseModel):
+    bucket: str
+    prefix: str = "archive" # folder for archived responses
+    mode: Literal["record", "replay"] = "record"
+
 class ModuleParams(BaseModel):
     page_size: Optional[int] = 2000
     fragment: Optional[bool] = False
@@ -45,9 +99,18 @@ class ModuleParams(BaseModel):
     partition_mapping: Optional[dict] = None
     params: Optional[dict] = None
     check_more: Optional[CheckMore] = None
+    pagination: Optional[Pagination] = None
     endpoint: Optional[str] = None
     auth: Optional[Auth] = None
     variables: Optional[dict] = None
+    connection: Optional[Connection] = None
+    rate_limit: Optional[RateLimit] = None
+    spool: Optional[Spool] = None
+    incremental: Optional[Incremental] = None
+    delta: Optional[Delta] = None
+    batch: Optional[Batch] = None
+    archive: Optional[Archive] = None
+    decoder: Optional[Decoder] = None
     mappings: Optional[dict] = None
     #
     make_objs: Optional[bool] = True
@@ -79,20 +142,48 @@ class myrequests(ModuleBase):
     partition_mapping: Optional[dict] = None
     params: Optional[dict] = None
     check_more: Optional[CheckMore] = None
+    pagination: Optional[Pagination] = None
     variables: Optional[dict] = None
+    connection: Optional[Connection] = None
+    rate_limit: Optional[RateLimit] = None
+    spool: Optional[Spool] = None
+    incremental: Optional[Incremental] = None
+    delta: Optional[Delta] = None
+    batch: Optional[Batch] = None
+    archive: Optional[Archive] = None
+    decoder: Optional[Decoder] = None
+
+    # class vars, compiled once in create_asset
+    predicate: Optional[Callable[[dict], bool]] = None
+    next_value: Optional[Any] = None
 
     def create_asset(self) -> AssetsDefinition:
+        self.__compile_pagination()
+        check_decoder(self.decoder)
+        if self.incremental and not (self.partition_mapping and self.partition_mapping.get("dates")):
+            raise ValueError("incremental mode requires partition_mapping.dates")
+        if self.batch and not (self.partition_mapping and self.partition_mapping.get("elements")):
+            raise ValueError("batch requires partition_mapping.elements")
+        if self.batch and self.incremental:
+            raise ValueError("batch can not be used together with incremental mode")
+        if self.batch and not self.__date_only_partition():
+            raise ValueError("batch requires date only partition")
+
         @asset(
         description="Gets data from an API and returns JSON obj",
         compute_kind="python",
+        required_resource_keys={'minio'} if self.spool or self.incremental or self.delta or self.archive else None,
         **self.asset_args
         )
         @asset_len
         @timed_asset
-        def get_api_data(context:OpExecutionContext) -> list:
+        def get_api_data(context:OpExecutionContext):
             # how to add partition integration?
             params = {}
             self.create_pk(context)
+            if self.batch:
+                # create_pk stores hourly and weekly keys as static, in batch mode the key is always the date
+                self.pk = {"date": context.partition_key}
             if self.partition_mapping and self.partition:
                 pk = self.pk
                 static, date = pk.get("static"), pk.get("date")
@@ -111,37 +202,276 @@ class myrequests(ModuleBase):
             if self.params:
                 params.update(self.params)
 
-            if self.check_more:
-                params[self.check_more.parameter] = 1
+            if self.delta:
+                self.__apply_delta(context, params)
+
+            if self.pagination and self.pagination.strategy == "page":
+                params[self.pagination.parameter] = self.pagination.start
 
             context.log.info(self.params)
             context.log.info(params)
 
-            if self.check_more:
-                res = []
-                while True:
-                # put while loop
-                    context.log.info(params)
-                    my_req = Request(self.endpoint, self.variables, self.auth, params)
-                    json_data = my_req.get_data().json()
-                    res.append(json_data)
-                    context.log.info(json_data)
-                    context.log.info(len(json_data))
-                    if eval(self.check_more.condition):
-                        print("I need to check more")
-                        print(f"I will use the next param for that {self.check_more.parameter}")
-                        params[self.check_more.parameter] += 1
-                        continue
-                    break
-                return res
-            else:
-                my_req = Request(self.endpoint, self.variables, self.auth, params)
-                json_data = my_req.get_data().json()
-                context.log.info(json_data)
+            if self.incremental:
+                return self.__fetch_incremental(context, params)
 
-                return [json_data]
+            if self.batch:
+                pages = self.__iter_batch_pages(context, params)
+            else:
+                pages = self.__iter_pages(context, params)
+            if self.spool:
+                file_name = self.spool.file_name.format(**self.pk)
+                return spool_pages(pages, context.resources.minio, self.spool.bucket, file_name)
+            return list(pages)
         return get_api_data
 
+    def __apply_delta(self, context:OpExecutionContext, params:dict) -> None:
+        """
+        Requests only objects changed after the last sync time. Without stored sync time or when full sync is due
+        all objects are requested. Due full sync is marked with the run id, so s3.merge_inventory of the same run replaces the inventory
+        """
+        minio = context.resources.minio
+        state = read_json_obj(minio, self.delta.bucket, self.delta.state)
+        since = state.get("since")
+        full_sync = not since or full_sync_due(state, self.delta.full_sync_hours)
+        if not full_sync:
+            params[self.delta.parameter] = self.delta.template.format(since=since)
+        elif since:
+            minio.upload_obj(self.delta.bucket, self.delta.state, json.dumps(dict(state, full_sync_run=context.run_id)).encode("utf-8"))
+        context.log.info(f"Last sync time {since}, requesting {'all' if full_sync else 'changed'} objects")
+        context.add_output_metadata({"delta_since": str(since), "delta_full_sync": full_sync})
+
+    def __iter_batch_pages(self, context:OpExecutionContext, params:dict) -> Iterator[dict]:
+        """
+        Fetches pages for all batch elements concurrently inside one run. Every page is tagged with its element
+        and yielded as soon as it arrives, the bounded queue keeps fetching threads close to the consumer
+        """
+        element_param = self.partition_mapping["elements"]
+        pages = queue.Queue(maxsize=self.batch.concurrency * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch_element(element:str) -> None:
+            count = 0
+            try:
+                for page in self.__iter_pages(context, dict(params, **{element_param: element})):
+                    if isinstance(page, dict):
+                        page[self.batch.tag] = element
+                    if not put(page):
+                        return
+                    count += 1
+                context.log.info(f"Element {element}: {count} pages received")
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        with ThreadPoolExecutor(max_workers=self.batch.concurrency) as executor:
+            for element in self.batch.elements:
+                executor.submit(fetch_element, element)
+            try:
+                remaining = len(self.batch.elements)
+                while remaining:
+                    item = pages.get()
+                    if item is done:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                # stops fetching threads if the consumer failed or stopped early
+                stop.set()
+
+    def __date_only_partition(self) -> bool:
+        """
+        Checks if asset has only date partition of any type (daily, hourly, weekly)
+        """
+        return bool(self.partition) and self.partition.date_partition is not None and self.partition.main_partition is self.partition.date_partition
+
+    def __fetch_incremental(self, context:OpExecutionContext, params:dict):
+        """
+        Requests only records newer than the stored watermark of the partition and merges new pages into the stored
+        partition pages. Watermark and pages are stored in the bucket per asset, element and date.
+        """
+        minio, bucket = context.resources.minio, self.incremental.bucket
+        folder = f"{self.incremental.prefix}/{self.asset_name}/{self.pk.get('static', 'all')}/{self.pk.get('date', 'all')}"
+        state = read_json_obj(minio, bucket, f"{folder}/state.json")
+
+        date_from = self.partition_mapping["dates"][0]
+        if state.get("watermark"):
+            params[date_from] = get_next_date_from(params[date_from], state["watermark"])
+            context.log.info(f"Watermark {state['watermark']}, requesting records from {params[date_from]}")
+
+        tracker = WatermarkTracker(self.incremental.path, state.get("watermark"))
+        new_pages = tracker.track(self.__iter_pages(context, params))
+        stored_pages = PageSpool(get_minio_params(minio), bucket, f"{folder}/pages.jsonl.gz", state.get("pages", 0)) if state else []
+        pages = spool_pages(chain(stored_pages, new_pages), minio, bucket, f"{folder}/pages.jsonl.gz")
+
+        state = {"watermark": tracker.watermark, "pages": len(pages)}
+        minio.upload_obj(bucket, f"{folder}/state.json", json.dumps(state).encode("utf-8"))
+        context.add_output_metadata({"incremental_watermark": str(tracker.watermark), "incremental_new_pages": tracker.pages})
+        return pages if self.spool else list(pages)
+
+    def __compile_pagination(self) -> None:
+        """
+        Converts check_more to page counter pagination and compiles pagination predicate and paths once
+        """
+        if self.check_more and not self.pagination:
+            self.pagination = Pagination(
+                parameter=self.check_more.parameter,
+                condition=self.check_more.condition,
+                concurrency=self.check_more.concurrency,
+                total_pages=self.check_more.total_pages,
+            )
+        if not self.pagination:
+            return
+
+        pagination = self.pagination
+        if pagination.strategy in ("page", "cursor") and not pagination.parameter:
+            raise ValueError(f"{pagination.strategy} pagination requires parameter")
+        if pagination.strategy == "page" and not (pagination.condition or pagination.jmespath):
+            raise ValueError("page pagination requires condition or jmespath")
+        if pagination.strategy == "cursor" and not pagination.cursor:
+            raise ValueError("cursor pagination requires cursor")
+
+        self.predicate = compile_predicate(pagination.condition, pagination.jmespath)
+        if pagination.strategy == "next_link":
+            self.next_value = jmespath.compile(pagination.next_link)
+        if pagination.strategy == "cursor":
+            self.next_value = jmespath.compile(pagination.cursor)
+
+    def __iter_pages(self, context:OpExecutionContext, params:dict) -> Iterator[dict]:
+        """
+        Yields pages from the endpoint one by one in page order
+        """
+        if not self.pagination:
+            json_data = self.__get_json(context, params)
+            context.log.info(json_data)
+            yield json_data
+            return
+
+        if self.pagination.strategy == "next_link":
+            yield from self.__iter_next_links(context, params)
+            return
+
+        if self.pagination.strategy == "cursor":
+            yield from self.__iter_cursor_pages(context, params)
+            return
+
+        if self.pagination.concurrency:
+            yield from self.__iter_pages_concurrently(context, params)
+            return
+
+        while True:
+        # put while loop
+            context.log.info(params)
+            json_data = self.__get_json(context, params)
+            context.log.info(json_data)
+            context.log.info(len(json_data))
+            yield json_data
+            if self.predicate(json_data):
+                print("I need to check more")
+                print(f"I will use the next param for that {self.pagination.parameter}")
+                params[self.pagination.parameter] += 1
+                continue
+            break
+
+    def __iter_next_links(self, context:OpExecutionContext, params:dict) -> Iterator[dict]:
+        """
+        Follows next page links provided by the server until the link is missing or predicate is false
+        """
+        endpoint, page_params = None, params
+        while True:
+            json_data = self.__get_json(context, page_params, endpoint)
+            yield json_data
+            next_link = self.next_value.search(json_data)
+            if not next_link or not self.predicate(json_data):
+                return
+            endpoint, page_params = urljoin(self.endpoint, next_link), None
+            context.log.info(f"Following next link {endpoint}")
+
+    def __iter_cursor_pages(self, context:OpExecutionContext, params:dict) -> Iterator[dict]:
+        """
+        Sends cursor from the previous page as parameter until the cursor is missing or predicate is false
+        """
+        page_params = params
+        while True:
+            json_data = self.__get_json(context, page_params)
+            yield json_data
+            cursor = self.next_value.search(json_data)
+            if cursor in (None, "") or not self.predicate(json_data):
+                return
+            page_params = dict(params, **{self.pagination.parameter: cursor})
+            context.log.info(f"Next cursor {cursor}")
+
+    def __get_json(self, context:OpExecutionContext, params:Optional[dict], endpoint:Optional[str] = None) -> dict:
+        """
+        Sends get request to the endpoint and returns decoded json. Variables are injected only to the configured endpoint.
+        Raw responses are stored to the archive in record mode and served from the archive in replay mode
+        """
+        if endpoint:
+            my_req = Request(endpoint, None, self.auth, params, self.connection, self.rate_limit)
+        else:
+            my_req = Request(self.endpoint, self.variables, self.auth, params, self.connection, self.rate_limit)
+
+        if not self.archive:
+            return my_req.get_json(self.decoder)
+
+        minio = context.resources.minio
+        archive_name = get_archive_name(self.archive.prefix, my_req.endpoint, params)
+        if self.archive.mode == "replay":
+            return read_archived_page(minio, self.archive.bucket, archive_name, self.decoder)
+
+        res = my_req.get_data()
+        json_data = decode(res.content, self.decoder)
+        archive_page(minio, self.archive.bucket, archive_name, res.content)
+        return json_data
+
+    def __iter_pages_concurrently(self, context:OpExecutionContext, params:dict) -> Iterator[dict]:
+        """
+        Gets the first page and fetches the remaining pages in parallel.
+        If total_pages is configured, the total amount of pages is taken from the first response,
+        otherwise pages are probed ahead in windows of pagination.concurrency pages.
+        """
+        parameter, concurrency = self.pagination.parameter, self.pagination.concurrency
+
+        def fetch_page(page:int) -> dict:
+            page_params = dict(params, **{parameter: page})
+            json_data = self.__get_json(context, page_params)
+            context.log.info(f"Page {page} received")
+            return json_data
+
+        first_params = dict(params)
+        if self.pagination.total_pages and self.pagination.total_pages.params:
+            first_params.update(self.pagination.total_pages.params)
+        first_page = params[parameter]
+        json_data = self.__get_json(context, first_params)
+        yield json_data
+
+        if not self.predicate(json_data):
+            return
+
+        total_pages = None
+        if self.pagination.total_pages:
+            total_pages = jmespath.search(self.pagination.total_pages.path, json_data)
+
+        if total_pages is None:
+            context.log.info(f"Probing pages ahead with concurrency {concurrency}")
+            yield from probe_pages(fetch_page, self.predicate, first_page + 1, concurrency)
+            return
+
+        context.log.info(f"Fetching {total_pages} pages with concurrency {concurrency}")
+        yield from fetch_pages(fetch_page, range(first_page + 1, int(total_pages) + 1), concurrency)
+
 @register_module("json_mapper")
 class json_mapper(ModuleBase):
     """
@@ -151,8 +481,15 @@ class json_mapper(ModuleBase):
     mappings: dict
     direct: Optional[bool] = False
     make_objs: Optional[bool] = True
+    tag: Optional[str] = None # page key added by http_get batch, its value is added to every object from the page
+    output: Literal["records", "dataframe"] = "records"
+
+    # class var, mappings compiled once in create_asset
+    compiled_mappings: dict = {}
 
     def create_asset(self) -> AssetsDefinition:
+        self.compiled_mappings = {key: jmespath.compile(value) for key, value in self.mappings.items()}
+
         @asset(
         description="Maps json data",
         compute_kind="python",
@@ -162,32 +499,32 @@ class json_mapper(ModuleBase):
         @timed_asset        
         def map_json(context:OpExecutionContext, data):
             context.log.info(data)
-            obj_mappings = dict()
-            
             context.log.info(self.direct)
 
             if self.direct:
                 for obj in data:
-                    for key, value in self.mappings.items():
-                        return jmespath.search(value, obj)
+                    return next(iter(self.compiled_mappings.values())).search(obj)
 
-            for key in self.mappings:
-                obj_mappings[key] = []
+            columns = {key: [] for key in self.compiled_mappings}
+            if self.tag:
+                columns[self.tag] = []
 
-            for obj in data:
-                for key, value in self.mappings.items():
-                    context.log.debug(jmespath.search(value, obj))
-                    search_res = jmespath.search(value, obj)
-                    if not isinstance(search_res, list):
-                        search_res = [search_res]
-                    obj_mappings[key] += search_res
+            for index, obj in enumerate(data):
+                page_columns = map_page(self.compiled_mappings, obj, index)
+                for key, values in page_columns.items():
+                    columns[key].extend(values)
+                if self.tag:
+                    columns[self.tag].extend([obj.get(self.tag)] * len(next(iter(page_columns.values()))))
+
+            if self.output == "dataframe":
+                return pd.DataFrame(columns)
 
             if self.make_objs:
-                res = get_mapping_objs(obj_mappings)
-                context.log.info(res)
+                keys = list(columns)
+                res = [dict(zip(keys, row)) for row in zip(*columns.values())]
+                context.log.info(f"{len(res)} objects mapped")
                 return res
-            context.log.info(obj_mappings)
-            return obj_mappings
+            return columns
         return map_json
     
 @register_module("questdb.api")
@@ -198,6 +535,7 @@ class QuestDbGet(ModuleBase):
 
     endpoint: str
     query: str
+    page_size: Optional[int] = None # rows per request, whole result is requested at once if not set
     # auth staff later
 
     def create_asset(self) -> AssetsDefinition:
@@ -210,14 +548,35 @@ class QuestDbGet(ModuleBase):
         def get_quest_db_data(context:OpExecutionContext) -> pd.DataFrame:
             self.create_pk(context)
             context.log.info(f"QuestDB endpoint:{self.endpoint}, Query: {self.query}")
-            res = Request(self.endpoint, [], None, params={"query":self.query.format(**self.pk)})
-            data = res.get_data()
-            print(data.status_code)
-            print(data.json())
-            data = data.json()
-            columns = [col["name"] for col in data["columns"]]
-            return pd.DataFrame(pd.DataFrame(data.get("dataset"), columns=columns))
+            params = {"query":self.query.format(**self.pk)}
+            if not self.page_size:
+                data = self.__get_json(params)
+                return questdb_frame(data["columns"], data.get("dataset", []))
+
+            frames, columns, offset = [], None, 0
+            while True:
+                page_params = dict(params, limit=f"{offset},{offset + self.page_size}")
+                if columns:
+                    page_params["nm"] = "true" # skip metadata after the first window
+                data = self.__get_json(page_params)
+                columns = columns if columns else data["columns"]
+                dataset = data.get("dataset", [])
+                frames.append(questdb_frame(columns, dataset))
+                context.log.info(f"Rows {offset}-{offset + len(dataset)} received")
+                if len(dataset) < self.page_size:
+                    break
+                offset += self.page_size
+            return pd.concat(frames, ignore_index=True)
         return get_quest_db_data
+
+    def __get_json(self, params:dict) -> dict:
+        """
+        Sends query to QuestDB /exec endpoint and returns decoded json
+        """
+        data = Request(self.endpoint, [], None, params=params).get_data().json()
+        if "error" in data:
+            raise DagsterError(f"QuestDB query failed: {data['error']}")
+        return data
     
 @register_module("date.timestamp")
 class AddTimestampToObjs(ModuleBase):
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Literal, Optional
 class ParamAuth(BaseModel):
     name: str
     token: str
@@ -20,3 +20,24 @@ class Auth(BaseModel):
     param_token: Optional[ParamAuth] = None
     bearer_token: Optional[BearerToken] = None
     api_key: Optional[APIKey] = None
+
+
+class Connection(BaseModel):
+    pool_size: int = 10 # max keep-alive connections per host
+    connect_timeout: Optional[float] = 10
+    read_timeout: Optional[float] = None
+
+class RateLimit(BaseModel):
+    rate: Optional[float] = None # requests per second per host, not limited if None
+    burst: int = 10 # max tokens in the bucket
+    max_concurrency: int = 16 # upper bound for adaptive concurrency per host
+    retries: int = 5 # retries for 429, 5xx and connection errors
+    backoff: float = 1 # base delay in seconds for exponential backoff
+    max_backoff: float = 60
+
+class Projection(BaseModel):
+    mappings: dict # json_mapper mappings of the data, records keep only the keys the mappings read
+
+class Decoder(BaseModel):
+    name: Literal["json", "orjson", "simdjson"] = "json"
+    projection: Optional[Projection] = None
@@ -1,36 +1,88 @@
-from io import BytesIO, StringIO
-from dagster import ConfigurableResource
+from io import BytesIO, IOBase, StringIO
+from dagster import ConfigurableResource, ConfigurableIOManagerFactory, InputContext, MetadataValue, OutputContext, UPathIOManager
 import requests
 from requests.auth import HTTPBasicAuth
 import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
 from minio import Minio
+from minio.error import S3Error
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from upath import UPath
 from dagster_factory_pipelines import registry
 
+DEFAULT_PART_SIZE = 10 * 1024 * 1024 # minimal part size of multipart upload is 5 MiB
+
+# long lived clients and confirmed buckets of the process, shared by all resource instances
+CLIENTS = {}
+KNOWN_BUCKETS = set()
+CLIENTS_LOCK = threading.Lock()
+
 @registry.register_resource("minio")    
 class MinioBucket(ConfigurableResource): # can be replaces with AWS3 resource
     access_key:str
     secret_key:str
     host:str
+    pool_size:int = 10 # connections kept to the host, also default concurrency of batch operations
 
     def create_client(self):
-        return Minio(
-            self.host,
-            # allow only env variables, because dagster exposes credentials in UI
-            access_key=os.getenv(self.access_key),
-            secret_key=os.getenv(self.secret_key),
-            secure=False
-        )
+        """
+        Returns pooled client of the process for the host and credentials, client is created on first use
+        """
+        # allow only env variables, because dagster exposes credentials in UI
+        access_key, secret_key = os.getenv(self.access_key), os.getenv(self.secret_key)
+        key = (self.host, access_key, secret_key, self.pool_size)
+        with CLIENTS_LOCK:
+            if key not in CLIENTS:
+                timeout = 300
+                http_client = urllib3.PoolManager(
+                    timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                    maxsize=self.pool_size,
+                    retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+                )
+                CLIENTS[key] = Minio(
+                    self.host,
+                    access_key=access_key,
+                    secret_key=secret_key,
+                    secure=False,
+                    http_client=http_client,
+                )
+            return CLIENTS[key]
     
     def create_bucket_if_not_exists(self, client, bucket_name):
+        """
+        Checks bucket once per process, confirmed and created buckets are remembered
+        """
+        if (self.host, bucket_name) in KNOWN_BUCKETS:
+            return
         if not client.bucket_exists(bucket_name):
-            client.make_bucket(bucket_name)
-            print(f"Bucket '{bucket_name}' created successfully.")
+            try:
+                client.make_bucket(bucket_name)
+                print(f"Bucket '{bucket_name}' created successfully.")
+            except S3Error as e:
+                # created by other thread or process in the meantime
+                if e.code not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                    raise
         else:
             print(f"Bucket '{bucket_name}' already exists.")
+        with CLIENTS_LOCK:
+            KNOWN_BUCKETS.add((self.host, bucket_name))
 
-    def upload_obj(self, bucket_name, file_name, obj) -> None:
+    def upload_obj(self, bucket_name, file_name, obj, part_size:int = DEFAULT_PART_SIZE) -> None:
+        """
+        Uploads bytes, StringIO or readable stream. Streams are uploaded in parts without knowing their length
+        """
         client = self.create_client()
         self.create_bucket_if_not_exists(client, bucket_name)
+        if isinstance(obj, (IOBase)) and not isinstance(obj, (StringIO, BytesIO)):
+            client.put_object(bucket_name, file_name, data=obj, length=-1, part_size=part_size)
+            return
         if isinstance(obj, StringIO):
             encoded_content = obj.getvalue().encode('utf-8') 
             buffer = BytesIO(encoded_content)
@@ -50,11 +102,267 @@ class MinioBucket(ConfigurableResource): # can be replaces with AWS3 resource
 
     def get_obj(self, bucket_name, obj_name) -> BytesIO:
         client = self.create_client()
+        response = client.get_object(bucket_name, obj_name)
         try:
-            response = client.get_object(bucket_name, obj_name)
             obj= BytesIO(response.data)
             
         finally:
             response.close()
             response.release_conn()
-        return obj
\ No newline at end of file
+        return obj
+
+    def upload_objs(self, bucket_name, objs:dict, concurrency:int = None, part_size:int = DEFAULT_PART_SIZE) -> None:
+        """
+        Uploads many objects (name: content or stream) at once using pooled client connections
+        """
+        client = self.create_client()
+        self.create_bucket_if_not_exists(client, bucket_name)
+        with ThreadPoolExecutor(max_workers=concurrency or self.pool_size) as executor:
+            # list raises first upload error
+            list(executor.map(lambda item: self.upload_obj(bucket_name, *item, part_size=part_size), objs.items()))
+
+    def get_objs(self, bucket_name, obj_names:list, concurrency:int = None, missing_ok:bool = False) -> dict:
+        """
+        Downloads many objects at once, returns dictionary of name and content. Missing objects are skipped if missing_ok
+        """
+        def get(obj_name):
+            try:
+                return obj_name, self.get_obj(bucket_name, obj_name)
+            except S3Error as e:
+                if missing_ok and e.code == "NoSuchKey":
+                    return obj_name, None
+                raise
+
+        with ThreadPoolExecutor(max_workers=concurrency or self.pool_size) as executor:
+            return {name: obj for name, obj in executor.map(get, obj_names) if obj is not None}
+
+    def upload_file(self, bucket_name, file_name, file_path) -> None:
+        """
+        Uploads local file to the bucket, large files are uploaded in multiple parts
+        """
+        client = self.create_client()
+        self.create_bucket_if_not_exists(client, bucket_name)
+        client.fput_object(bucket_name, file_name, file_path)
+
+    def download_file(self, bucket_name, obj_name, file_path) -> None:
+        """
+        Downloads object from the bucket to the local file
+        """
+        client = self.create_client()
+        client.fget_object(bucket_name, obj_name, file_path)
+
+    def stat_obj(self, bucket_name, obj_name):
+        """
+        Returns object metadata (etag, size, last_modified) without downloading it
+        """
+        client = self.create_client()
+        return client.stat_object(bucket_name, obj_name)
+
+    def remove_obj(self, bucket_name, obj_name) -> None:
+        client = self.create_client()
+        client.remove_object(bucket_name, obj_name)
+
+    def list_objs(self, bucket_name, prefix:str, recursive:bool = True) -> list:
+        """
+        Returns objects under the prefix, folders are skipped
+        """
+        client = self.create_client()
+        return [obj for obj in client.list_objects(bucket_name, prefix=prefix, recursive=recursive) if not obj.is_dir]
+
+    def get_stream(self, bucket_name, obj_name):
+        """
+        Returns not preloaded response for reading object in chunks. Caller should close and release the response
+        """
+        client = self.create_client()
+        return client.get_object(bucket_name, obj_name)
+
+
+PARQUET_MAGIC = b"PAR1"
+KIND_KEY = b"cumo.kind"
+
+
+def is_nested(data_type) -> bool:
+    return pa.types.is_nested(data_type) or (pa.types.is_dictionary(data_type) and pa.types.is_nested(data_type.value_type))
+
+
+def to_table(obj):
+    """
+    Converts list of dictionaries or dataframe to arrow table. Returns None when object can not be stored column by column
+    without changing it (other objects, ragged or nested records, mixed column types), such objects are pickled
+    """
+    try:
+        if isinstance(obj, pd.DataFrame):
+            table = pa.Table.from_pandas(obj)
+            kind = b"dataframe"
+        elif isinstance(obj, list) and obj and all(isinstance(row, dict) for row in obj):
+            keys = list(obj[0])
+            if any(len(row) != len(keys) or row.keys() != obj[0].keys() for row in obj):
+                return None
+            table = pa.table({key: [row[key] for row in obj] for key in keys})
+            kind = b"records"
+        else:
+            return None
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError):
+        return None
+    if any(is_nested(field.type) for field in table.schema):
+        return None
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), KIND_KEY: kind})
+
+
+def from_table(table: pa.Table):
+    if table.schema.metadata.get(KIND_KEY) == b"records":
+        return table.to_pylist()
+    return table.to_pandas()
+
+
+class MinioParquetIOManager(UPathIOManager):
+    """
+    Stores list of dictionaries and dataframes as compressed parquet files, other outputs are pickled.
+    Objects are loaded memory mapped from local cache, that is revalidated by object etag.
+    Uses same object layout as S3PickleIOManager, so pickles written by it can be still loaded.
+    """
+    def __init__(self, minio: MinioBucket, bucket: str, prefix: str, compression: str, cache_dir: str,
+                 cache_max_bytes: int = 2 * 1024 ** 3, cache_max_age: int = 24 * 3600):
+        self.minio = minio
+        self.bucket = bucket
+        self.compression = compression
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_max_age = cache_max_age
+        self.last_format = None
+        super().__init__(base_path=UPath(prefix))
+
+    def __cache_path(self, path: UPath) -> str:
+        return os.path.join(self.cache_dir, self.bucket, path.as_posix())
+
+    def __replace(self, file_path: str, etag: str, tmp_path: str) -> None:
+        # writing through temporary file, because other processes may read the same object
+        os.replace(tmp_path, file_path)
+        with open(file_path + ".etag", "w") as file:
+            file.write(etag)
+
+    def __cached_etag(self, file_path: str):
+        try:
+            with open(file_path + ".etag") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def __cleanup_cache(self, keep: str) -> None:
+        """
+        Removes cached files not used for cache_max_age seconds, then least recently used files above cache_max_bytes.
+        Files without etag are downloads in progress and are removed only when expired, keep is the file being loaded
+        """
+        now = time.time()
+        entries, size = [], 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".etag"):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                cached = os.path.exists(file_path + ".etag")
+                if file_path == keep:
+                    size += stat.st_size
+                elif now - stat.st_mtime > self.cache_max_age:
+                    self.__remove_cached(file_path)
+                elif cached:
+                    entries.append((stat.st_mtime, stat.st_size, file_path))
+                    size += stat.st_size
+        for _, file_size, file_path in sorted(entries):
+            if size <= self.cache_max_bytes:
+                break
+            self.__remove_cached(file_path)
+            size -= file_size
+
+    def __remove_cached(self, file_path: str) -> None:
+        # memory mapped readers keep the removed file until they close it
+        for name in (file_path + ".etag", file_path):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def dump_to_path(self, context: OutputContext, obj, path: UPath) -> None:
+        table = to_table(obj)
+        # outputs are not cached, only loaded inputs are kept locally
+        fd, tmp_path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as file:
+                if table is None:
+                    pickle.dump(obj, file, pickle.HIGHEST_PROTOCOL)
+                else:
+                    pq.write_table(table, file, compression=self.compression)
+            self.last_format = "pickle" if table is None else "parquet"
+            self.minio.upload_file(self.bucket, path.as_posix(), tmp_path)
+        finally:
+            os.remove(tmp_path)
+
+    def load_from_path(self, context: InputContext, path: UPath):
+        file_path = self.__cache_path(path)
+        try:
+            etag = self.minio.stat_obj(self.bucket, path.as_posix()).etag
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchBucket"):
+                raise FileNotFoundError(f"Could not find file {path} in bucket {self.bucket}")
+            raise
+        if self.__cached_etag(file_path) != etag or not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+            os.close(fd)
+            try:
+                self.minio.download_file(self.bucket, path.as_posix(), tmp_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self.__replace(file_path, etag, tmp_path)
+            self.__cleanup_cache(file_path)
+        else:
+            os.utime(file_path) # cache hit, least recently used files are removed first
+        with open(file_path, "rb") as file:
+            magic = file.read(4)
+            if magic != PARQUET_MAGIC:
+                file.seek(0)
+                return pickle.load(file)
+        return from_table(pq.read_table(file_path, memory_map=True))
+
+    def path_exists(self, path: UPath) -> bool:
+        try:
+            self.minio.stat_obj(self.bucket, path.as_posix())
+        except S3Error:
+            return False
+        return True
+
+    def unlink(self, path: UPath) -> None:
+        self.minio.remove_obj(self.bucket, path.as_posix())
+
+    def make_directory(self, path: UPath) -> None:
+        return None
+
+    def get_metadata(self, context: OutputContext, obj) -> dict:
+        # called right after dump_to_path for the same output
+        return {"format": MetadataValue.text(self.last_format)} if obj is not None else {}
+
+
+@registry.register_resource("parquet_io")
+class ParquetIOManager(ConfigurableIOManagerFactory):
+    """
+    IO manager storing list of dictionaries and dataframes as columnar parquet files in minio.
+    Should be registered with name io_manager to replace pickle IO manager.
+    """
+    access_key: str
+    secret_key: str
+    host: str
+    bucket: str = "dagster-io"
+    prefix: str = "dagster"
+    compression: str = "zstd"
+    cache_dir: str = os.path.join(tempfile.gettempdir(), "cumo-io")
+    cache_max_bytes: int = 2 * 1024 ** 3 # least recently used files above the size are removed
+    cache_max_age: int = 24 * 3600 # seconds, files not used longer are removed
+
+    def create_io_manager(self, context) -> MinioParquetIOManager:
+        minio = MinioBucket(access_key=self.access_key, secret_key=self.secret_key, host=self.host)
+        return MinioParquetIOManager(minio, self.bucket, self.prefix, self.compression, self.cache_dir, self.cache_max_bytes, self.cache_max_age)
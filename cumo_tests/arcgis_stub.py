@@ -0,0 +1,104 @@
+import asyncio
+import json
+import threading
+from aiohttp import web
+
+FIELDS = [
+    {"name": "OBJECTID", "type": "esriFieldTypeOID"},
+    {"name": "source_id", "type": "esriFieldTypeString"},
+    {"name": "value_", "type": "esriFieldTypeDouble"},
+]
+
+
+class FeatureServiceStub:
+    """
+    Local feature service with one sublayer, supports uploads, append jobs and addFeatures.
+    Append job reports InProgress on the first status request and job_status afterwards
+    """
+    def __init__(self, layer_name:str = "service", sublayer_name:str = "Lights", job_status:str = "Completed", job_error:dict = None):
+        self.layer_name = layer_name
+        self.sublayer_name = sublayer_name
+        self.job_status = job_status
+        self.job_error = job_error
+        self.features = [] # attributes of stored features
+        self.uploads = {} # item id to uploaded content
+        self.deleted_uploads = []
+        self.calls = []
+        self.port = None
+        self.loop = asyncio.new_event_loop()
+
+    def start(self) -> "FeatureServiceStub":
+        ready = threading.Event()
+        threading.Thread(target=self.__run, args=(ready,), daemon=True).start()
+        ready.wait(10)
+        return self
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def __run(self, ready:threading.Event) -> None:
+        asyncio.set_event_loop(self.loop)
+        base = f"/arcgis/rest/services/{self.layer_name}/FeatureServer"
+        app = web.Application()
+        app.router.add_get(base, self.__layers)
+        app.router.add_get(base + "/0", self.__fields)
+        app.router.add_post(base + "/uploads/upload", self.__upload)
+        app.router.add_post(base + "/uploads/{item_id}/delete", self.__delete_upload)
+        app.router.add_post(base + "/0/append", self.__append)
+        app.router.add_post(base + "/0/addFeatures", self.__add_features)
+        app.router.add_get("/jobs/{job_id}", self.__job_status)
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        self.loop.run_forever()
+
+    async def __layers(self, request:web.Request) -> web.Response:
+        self.calls.append("layers")
+        return web.json_response({"layers": [{"id": 0, "name": self.sublayer_name}]})
+
+    async def __fields(self, request:web.Request) -> web.Response:
+        self.calls.append("fields")
+        return web.json_response({"fields": FIELDS})
+
+    async def __upload(self, request:web.Request) -> web.Response:
+        self.calls.append("upload")
+        form = await request.post()
+        item_id = f"item{len(self.uploads)}"
+        self.uploads[item_id] = form["file"].file.read()
+        return web.json_response({"success": True, "item": {"itemID": item_id}})
+
+    async def __delete_upload(self, request:web.Request) -> web.Response:
+        self.calls.append("delete")
+        self.deleted_uploads.append(request.match_info["item_id"])
+        return web.json_response({"success": True})
+
+    async def __append(self, request:web.Request) -> web.Response:
+        self.calls.append("append")
+        form = await request.post()
+        self.job = {"item_id": form["appendUploadId"], "mappings": json.loads(form["fieldMappings"]), "polls": 0}
+        return web.json_response({"statusUrl": f"http://127.0.0.1:{self.port}/jobs/job0"})
+
+    async def __job_status(self, request:web.Request) -> web.Response:
+        self.calls.append("status")
+        self.job["polls"] += 1
+        if self.job["polls"] == 1:
+            return web.json_response({"status": "InProgress"})
+        if self.job_status != "Failed" and "done" not in self.job:
+            names = {mapping["name"] for mapping in self.job["mappings"]}
+            collection = json.loads(self.uploads[self.job["item_id"]])
+            self.features += [{key: value for key, value in feature["properties"].items() if key in names} for feature in collection["features"]]
+            self.job["done"] = True
+        status = {"status": self.job_status}
+        if self.job_error:
+            status["error"] = self.job_error
+        return web.json_response(status)
+
+    async def __add_features(self, request:web.Request) -> web.Response:
+        self.calls.append("addFeatures")
+        form = await request.post()
+        features = json.loads(form["features"])
+        self.features += [feature["attributes"] for feature in features]
+        return web.json_response({"addResults": [{"success": True} for _ in features]})
@@ -0,0 +1,65 @@
+import pytest
+from dagster import asset, materialize
+
+from cumo.modules.arcgis.module import ArcGIS, send_to_arcgis
+from .arcgis_stub import FeatureServiceStub
+
+FEATURES = [
+    {"attributes": {"source_id": str(i), "value_": i / 2, "extra": "x"}, "geometry": {"x": 26.7, "y": 58.4, "spatialReference": {"wkid": 4326}}}
+    for i in range(10)
+]
+
+
+@asset
+def features():
+    return FEATURES
+
+
+@pytest.fixture
+def stub(request):
+    service = FeatureServiceStub(**getattr(request, "param", {})).start()
+    yield service
+    service.stop()
+
+
+def load(stub:FeatureServiceStub, tmp_path, monkeypatch):
+    monkeypatch.setenv("ARCGIS_TOKEN", "token")
+    arcgis = ArcGIS(token="ARCGIS_TOKEN", feature_service_address=f"127.0.0.1:{stub.port}", scheme="http",
+                    skip_validation=True, cache_dir=str(tmp_path))
+    module = send_to_arcgis(asset_name="load", asset_in="features", layer_name=stub.layer_name, sublayer_name=stub.sublayer_name, req_cols=["source_id", "value_"],
+                            append_threshold=5, poll_interval=0, retries=0)
+    result = materialize([features, module.create_asset()], resources={"arcGIS": arcgis})
+    event = next(event for event in result.get_asset_materialization_events() if event.asset_key.path == ["load"])
+    return {key: getattr(value, "value", value) for key, value in event.materialization.metadata.items()}
+
+
+def test_append_uploads_polls_and_deletes(stub, tmp_path, monkeypatch):
+    metadata = load(stub, tmp_path, monkeypatch)
+
+    assert [call for call in stub.calls if call not in ("layers", "fields")] == ["upload", "append", "status", "status", "delete"]
+    assert stub.deleted_uploads == list(stub.uploads)
+    assert stub.features == [{"source_id": str(i), "value_": i / 2} for i in range(10)]
+    assert metadata["append_status"] == "Completed"
+    assert metadata["added"] == 10
+    assert metadata["failed"] == 0
+
+
+@pytest.mark.parametrize("stub", [{"job_status": "CompletedWithErrors", "job_error": {"code": 500, "description": "2 features failed"}}], indirect=True)
+def test_append_completed_with_errors_in_metadata(stub, tmp_path, monkeypatch):
+    metadata = load(stub, tmp_path, monkeypatch)
+
+    assert "addFeatures" not in stub.calls
+    assert metadata["append_status"] == "CompletedWithErrors"
+    assert metadata["append_error"]["error"] == {"code": 500, "description": "2 features failed"}
+
+
+@pytest.mark.parametrize("stub", [{"job_status": "Failed", "job_error": {"code": 400, "description": "rolled back"}}], indirect=True)
+def test_failed_append_falls_back_to_add_features(stub, tmp_path, monkeypatch):
+    metadata = load(stub, tmp_path, monkeypatch)
+
+    assert stub.calls.count("addFeatures") == 1
+    assert stub.deleted_uploads == list(stub.uploads)
+    assert len(stub.features) == 10
+    assert metadata["append_status"] == "Failed"
+    assert metadata["append_error"] == {"code": 400, "description": "rolled back"}
+    assert metadata["added"] == 10
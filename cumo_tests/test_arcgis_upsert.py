@@ -0,0 +1,40 @@
+import pytest
+from dagster_factory_pipelines.factory.factory import Partition
+
+from cumo.modules.arcgis.module import send_to_arcgis
+
+FIELD_TYPES = {"source_id": "esriFieldTypeString", "date_": "esriFieldTypeDate"}
+
+
+def module(upsert:dict) -> send_to_arcgis:
+    partition = Partition(type="daily", start="2024-01-01", elements=["Light", "Cell"]).create_partition()
+    return send_to_arcgis(asset_name="load", layer_name="service", sublayer_name="Lights", partition=partition, upsert=upsert)
+
+
+@pytest.mark.parametrize("upsert", [
+    {"keys": ["source_id"]},
+    {"keys": ["source_id", "date_"], "range_col": "date_", "delete_missing": True},
+    {"keys": ["source_id"], "where": "dal_series = '{element}'"},
+])
+def test_unscoped_upsert_is_rejected(upsert):
+    with pytest.raises(ValueError):
+        module(upsert).create_asset()
+
+
+def test_where_is_scoped_to_partition_and_keys():
+    load = module({"keys": ["source_id", "date_"], "range_col": "date_", "where": "dal_series = '{static}'", "delete_missing": True})
+    load.create_asset()
+    load.pk = {"date": "2024-05-01", "static": "Light"}
+    data = [
+        {"attributes": {"source_id": "b'x", "date_": "2024-05-01T10:00:00"}},
+        {"attributes": {"source_id": "a", "date_": "2024-05-01T12:00:00"}},
+        {"attributes": {"source_id": None, "date_": "2024-05-01T12:00:00"}},
+    ]
+
+    where = load._send_to_arcgis__upsert_where(data, FIELD_TYPES)
+
+    assert where == (
+        "(dal_series = 'Light')"
+        " AND date_ >= TIMESTAMP '2024-05-01 10:00:00' AND date_ < TIMESTAMP '2024-05-01 12:00:01'"
+        " AND (source_id IN ('a', 'b''x') OR source_id IS NULL)"
+    )
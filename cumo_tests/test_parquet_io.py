@@ -0,0 +1,55 @@
+import hashlib
+import os
+import types
+
+from upath import UPath
+
+from cumo.resources.resources import MinioParquetIOManager
+
+
+class Bucket:
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, bucket:str, name:str, file_path:str):
+        with open(file_path, "rb") as file:
+            self.objects[name] = file.read()
+
+    def stat_obj(self, bucket:str, name:str):
+        return types.SimpleNamespace(etag=hashlib.md5(self.objects[name]).hexdigest())
+
+    def download_file(self, bucket:str, name:str, file_path:str):
+        with open(file_path, "wb") as file:
+            file.write(self.objects[name])
+
+
+def cached_files(cache_dir) -> list:
+    return sorted(name for _, _, names in os.walk(cache_dir) for name in names if not name.endswith(".etag"))
+
+
+def test_outputs_are_not_cached(tmp_path):
+    io_manager = MinioParquetIOManager(Bucket(), "bucket", "dagster", "zstd", str(tmp_path))
+
+    io_manager.dump_to_path(None, [{"x": 1}], UPath("dagster/a"))
+
+    assert cached_files(tmp_path) == []
+    assert io_manager.load_from_path(None, UPath("dagster/a")) == [{"x": 1}]
+    assert cached_files(tmp_path) == ["a"]
+
+
+def test_cache_is_limited_by_size_and_age(tmp_path):
+    bucket = Bucket()
+    io_manager = MinioParquetIOManager(bucket, "bucket", "dagster", "zstd", str(tmp_path), cache_max_bytes=1, cache_max_age=3600)
+    for name in ("a", "b", "c"):
+        io_manager.dump_to_path(None, [{"x": i} for i in range(100)], UPath(f"dagster/{name}"))
+
+    io_manager.load_from_path(None, UPath("dagster/a"))
+    io_manager.load_from_path(None, UPath("dagster/b"))
+    # only the file being loaded is kept above cache_max_bytes
+    assert cached_files(tmp_path) == ["b"]
+
+    io_manager.cache_max_bytes = 2 * 1024 ** 3
+    expired = os.path.join(tmp_path, "bucket", "dagster", "b")
+    os.utime(expired, (0, 0))
+    io_manager.load_from_path(None, UPath("dagster/c"))
+    assert cached_files(tmp_path) == ["c"]
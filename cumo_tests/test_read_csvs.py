@@ -0,0 +1,40 @@
+import gzip
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cumo.modules.general.helpers import PROCESS_START_METHOD, parse_csv_in_process, read_csvs_concurrently
+
+
+class Response(io.BytesIO):
+    def __init__(self, content:bytes):
+        super().__init__(content)
+        self.headers = {"Content-Length": str(len(content))}
+
+    def release_conn(self):
+        pass
+
+
+class Bucket:
+    def __init__(self, files:dict):
+        self.files = files
+
+    def get_stream(self, bucket:str, file_name:str) -> Response:
+        return Response(self.files[file_name])
+
+
+def test_large_files_are_parsed_in_processes():
+    large = "a,b\n" + "".join(f"{i},x{i}\n" for i in range(1000))
+    files = {"small.csv": b"a,b\n1,y\n", "large.csv.gz": gzip.compress(large.encode())}
+
+    frames = read_csvs_concurrently(Bucket(files), "bucket", ["small.csv", "missing.csv", "large.csv.gz"], parse_processes=1, large_file_bytes=100)
+
+    assert [frame.shape for frame in frames] == [(1, 2), (1000, 2)]
+    assert frames[1]["b"].iloc[-1] == "x999"
+
+
+def test_workers_do_not_build_definitions():
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context(PROCESS_START_METHOD)) as processes:
+        assert parse_csv_in_process(processes, b"a\n1\n").shape == (1, 1)
+        # importing cumo would run cumo/__init__.py and build every pipeline definition
+        assert not processes.submit(eval, "'cumo' in __import__('sys').modules").result()